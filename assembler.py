@@ -1,25 +1,242 @@
-from instructions import ADDRESS_INCREMENT
-from parser import parse_asm, Label, ParserInput
+from instructions import AssemblyError
+from output import FORMATS, OUTPUT_FORMATS, RECORD_FORMATS, write_machine_code, write_rom_image
+from stats import Stats
 
-import argparse
-from pathlib import Path
+import os
 import sys
 
-OUTPUT_FORMATS = ['words', 'bytes', 'binary']
+# Most runs assemble one small file, so startup time matters. Modules that only some options need (the cache, NumPy,
+# the process pool, argparse for library use) are imported where they are used rather than here.
+
+# Parse and encode the source, splitting it across up to workers processes if it is big enough.
+# Returns (MemoryImage, {label name: address}): the image holds the words of every segment, image.dense() the machine
+# code from address 0 with the gaps filled with zeros (see image.py). Each step is timed as a phase of stats, if
+# given. If a source_map is given (see listing.py), the source location of every word is recorded in it while
+# encoding.
+# Raises AssemblySyntaxError if the source can't be parsed and AssemblyError if it can't be encoded.
+def assemble_source(asm_text, args, workers=1, stats=None, path=None, source_map=None):
+    if stats is None:
+        stats = Stats(enabled=False)
+
+    with stats.phase('import'):
+        from encoder import Assembler, AssemblySyntaxError, assign_label_addresses
+        from image import MemoryImage
+        from parser import start_counting, stop_counting
+        from preprocessor import needs_preprocessing, Preprocessor
+
+    optimize = getattr(args, 'optimize', False)
+    relax = getattr(args, 'relax', False)
+    if workers > 1 and not args.numpy and not optimize and not relax and source_map is None:
+        from parallel import assemble_parallel
+        with stats.phase('assemble'):
+            try:
+                machine_code, labels = assemble_parallel(asm_text, workers, args.fast, args.all_errors)
+                return MemoryImage.from_words(machine_code), labels
+            except AssemblySyntaxError:
+                # Sources using includes, macros or pseudo-instructions don't parse in chunks, they are expanded as a
+                # whole below
+                if not needs_preprocessing(asm_text):
+                    raise
+
+    # First pass: Parse text into syntax tree (not a very impressive tree as assembly has no nesting structure), with
+    # includes, macros and pseudo-instructions expanded. Raises AssemblySyntaxError.
+    with stats.phase('parse', getattr(args, 'profile', None)):
+        if stats.enabled:
+            start_counting()
+        try:
+            items = Preprocessor(args.fast, args.all_errors).process(asm_text, path)
+        finally:
+            if stats.enabled:
+                stats.counters.update(stop_counting())
+
+    if optimize:
+        from optimize import optimize_items
+        with stats.phase('optimize'):
+            items, removed = optimize_items(items)
+        if stats.enabled:
+            stats.counters.update(removed)
+
+    if relax:
+        from relax import relax_branches
+        with stats.phase('relax'):
+            items, relaxed = relax_branches(items)
+        if stats.enabled:
+            stats.counters.update(relaxed_branches=relaxed)
+
+    # Second pass: assign label addresses and generate machine code, patching forward references at the end
+    if args.numpy:
+        from vector_encoder import encode_items
+        with stats.phase('labels'):
+            label_addresses = assign_label_addresses(items)
+        with stats.phase('encode'):
+            image = MemoryImage.from_words(encode_items(items, label_addresses).tolist())
+    else:
+        assembler = Assembler(source_map=source_map)
+        # Labels are assigned while encoding, forward references are encoded by finish()
+        with stats.phase('encode'):
+            assembler.add_all(items)
+        with stats.phase('fixups'):
+            assembler.finish()
+            image = assembler.image()
+        label_addresses = assembler.label_addresses
+
+    if stats.enabled:
+        instructions = len(image)
+        tokens = sum(1 if not hasattr(item.value, '__iter__') else sum(1 for it in item.value if it.loc >= 0)
+                     for item in items)
+        stats.counters.update(items=len(items), instructions=instructions, labels=len(label_addresses),
+                              tokens=tokens)
+        stats.add_rate('parse tokens/s', tokens, 'parse')
+        stats.add_rate('parse instructions/s', instructions, 'parse')
+        stats.add_rate('encode instructions/s', instructions, 'encode')
+    return image, {label.name: address for label, address in label_addresses.items()}
+
+
+# Assemble infile and write the machine code to outfile, reusing the cached machine code if there is any.
+# Returns the number of instruction words and whether they came from the cache. Raises AssemblyError on errors, in
+# which case outfile isn't written.
+def assemble_file(infile, outfile, out_format, args, cache=None, workers=1, stats=None):
+    if stats is None:
+        stats = Stats(enabled=False)
+
+    with stats.phase('read'):
+        with open(infile, 'r') as asmfile:
+            asm_text = asmfile.read()
+
+    # The cache is keyed by the source text, which doesn't cover the files it includes. It only holds the machine code,
+    # so it isn't used when a listing or source map is written either.
+    source_map = None
+    if getattr(args, 'listing', None) is not None or getattr(args, 'map', None) is not None:
+        from listing import SourceMap
+        source_map = SourceMap()
+        cache = None
+    if cache is not None:
+        from preprocessor import uses_includes
+        if uses_includes(asm_text):
+            cache = None
+
+    cached = None
+    if cache is not None:
+        with stats.phase('cache'):
+            cached = cache.get(asm_text, cache_variant(args))
+    if cached is not None:
+        image, labels = cached
+    else:
+        image, labels = assemble_source(asm_text, args, workers, stats, infile, source_map)
+        if cache is not None:
+            with stats.phase('cache'):
+                cache.put(asm_text, image, labels, cache_variant(args))
+
+    # Write output to file
+    with stats.phase('write'):
+        if args.rom:
+            write_rom_image(outfile, image, out_format, args.skip_odd, args.base)
+        else:
+            with open(outfile, 'wb' if FORMATS[out_format].binary else 'w') as outfile:
+                write_machine_code(outfile, image, out_format, args.skip_odd, args.base)
+    if source_map is not None:
+        with stats.phase('listing'):
+            from listing import write_listing
+            if args.listing is not None:
+                with open(args.listing, 'w') as listing_file:
+                    write_listing(listing_file, asm_text, source_map, image)
+            if args.map is not None:
+                source_map.save(args.map, infile)
+    return len(image), cached is not None
+
+
+def display_assembly_error(e, all_errors):
+    if hasattr(e, 'parse_input'):  # AssemblySyntaxError
+        if e.path is not None:
+            print('In {}:'.format(e.path))
+        if all_errors and e.parse_input.errors is not None:
+            e.parse_input.display_errors(4, 5)
+        else:
+            e.parse_input.display_error(e.error, 4, 5)
+    else:
+        print('Error: {}'.format(e))
+
+
+def default_output(infile, out_format):
+    return os.path.splitext(infile)[0] + FORMATS[out_format].suffix
+
+
+# Options that change the machine code for the same source, part of the cache key
+def cache_variant(args):
+    return '+'.join(option for option in ['optimize', 'relax'] if getattr(args, option, False))
+
+
+# Returns the AssemblyCache for --cache, or None if it isn't used
+def open_cache(args):
+    if args.cache is None:
+        return None
+    from cache import AssemblyCache, DEFAULT_MAX_SIZE
+    max_size = DEFAULT_MAX_SIZE if args.cache_size is None else int(args.cache_size * 1024 * 1024)
+    return AssemblyCache(args.cache, max_size)
 
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', metavar='INPUT', type=str, help='Assembly file to read')
+    parser.add_argument('infile', metavar='INPUT', type=str, nargs='*',
+                        help='Assembly file to read. With more than one input, glob patterns or a manifest, every '
+                             'file is assembled in batch mode')
     parser.add_argument('-f', metavar='Format', type=str, default='bytes', help='Format to use when writing output '
-                                                                                'file ("words", "bytes", or "binary")')
-    parser.add_argument('-o', metavar='OUTPUT', type=str, help='File to write hexadecimal machine code into')
+                                                                                'file ("words", "bytes", "binary", '
+                                                                                '"raw_be", "raw_le", "ihex" or "memh")')
+    parser.add_argument('-o', metavar='OUTPUT', type=str, help='File to write hexadecimal machine code into (in batch '
+                                                                 'mode, the directory to write every output file into)')
+    parser.add_argument('-m', '--manifest', metavar='FILE', type=str,
+                        help='Also assemble every file listed in FILE (one path per line), in batch mode')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Number of processes to use (default: one per CPU in batch mode, one for a single file). '
+                             'A single large file is split into chunks that are assembled in parallel')
 
+    parser.add_argument('--base', metavar='ADDRESS', type=lambda value: int(value, 0), default=0,
+                        help='Byte address of the first instruction in ihex and memh output, or the offset to write '
+                             'at with --rom')
+    parser.add_argument('--rom', action='store_const', const=True, default=False,
+                        help='Write the program into the existing ROM image OUTPUT at offset --base instead of '
+                             'replacing it (raw_be and raw_le formats)')
     parser.add_argument('-s', '--skip_odd', action='store_const', const=True, default=False, help='Write zeros to odd addresses')
+    parser.add_argument('-e', '--all_errors', action='store_const', const=True, default=False,
+                        help='Report every line with a syntax error instead of stopping at the first one')
+    parser.add_argument('--fast', action='store_const', const=True, default=False,
+                        help='Decode well-formed lines directly, only using the full parser for the rest')
+    parser.add_argument('--numpy', action='store_const', const=True, default=False,
+                        help='Encode all instructions at once with NumPy')
+    parser.add_argument('-O', '--optimize', action='store_const', const=True, default=False,
+                        help='Remove writes to $zero and jumps to the next instruction and fold consecutive addi')
+    parser.add_argument('--relax', action='store_const', const=True, default=False,
+                        help='Rewrite branches whose target is out of range into a branch over a jump')
+    parser.add_argument('--listing', metavar='FILE', type=str,
+                        help='Write a listing (every source line with the address and words assembled from it) to FILE')
+    parser.add_argument('--map', metavar='FILE', type=str,
+                        help='Write the address and source offset of every instruction and the address of every label '
+                             'to FILE, as JSON')
+    parser.add_argument('--stream', action='store_const', const=True, default=False,
+                        help='Assemble line by line, writing output as it goes (uses little memory on huge sources, '
+                             'but each instruction must be on a single line)')
+    parser.add_argument('--cache', metavar='DIR', type=str,
+                        help='Reuse the machine code from an earlier run on the same source, stored in DIR')
+    parser.add_argument('--cache_size', metavar='MB', type=float,
+                        help='Remove the least recently used entries once the cache is bigger than this (default 64)')
+    parser.add_argument('--cache_stats', action='store_const', const=True, default=False,
+                        help='Print the total number of cache hits and misses')
+    parser.add_argument('--stats', nargs='?', const='text', choices=['text', 'json'],
+                        help='Print the time and peak memory of every phase, parser counters and rates, as text '
+                             '(default) or JSON')
+    parser.add_argument('--no_memory_stats', action='store_const', const=True, default=False,
+                        help="Don't track memory for --stats (tracking memory slows assembly down)")
+    parser.add_argument('--profile', metavar='FILE', type=str,
+                        help='Write a cProfile profile of the parse phase to FILE (read it with pstats)')
+    parser.add_argument('--watch', action='store_const', const=True, default=False,
+                        help='Keep running and re-assemble whenever the input changes, only re-encoding and rewriting '
+                             'the instructions that changed (each instruction must be on a single line)')
 
     args = parser.parse_args()
 
-    asmfile = args.infile
     outfile = args.o
 
     out_format = args.f.lower()
@@ -29,99 +246,84 @@ def main():
         print('Unsupported output format "{}"'.format(out_format))
         sys.exit(1)
 
-    if outfile is None:
-        suffix = '.txt' if out_format == 'binary' else '.hex'
-        outfile = Path(asmfile)
-        outfile = outfile.with_suffix(suffix)
-
-    # First pass: Parse text into syntax tree (not a very impressive tree as assembly has no nesting structure)
-    with open(asmfile, 'r') as asmfile:
-        asm_text = asmfile.read()
-        # print(len(asm_text))
-        parse_input = ParserInput(asm_text)
-        ast, rem = parse_asm(parse_input)
-        # if len(rem.rtext()) > 0:
-        #     print('Failed to parse entire file. Remainder: {}'.format(rem.rtext()))
-
-        if ast.error():
-            # print(ast)
-            parse_input.display_error(ast, 4, 5)
+    if args.rom and not FORMATS[out_format].binary:
+        print('--rom requires a raw output format')
+        sys.exit(1)
+    if args.base and not args.rom and out_format not in ['ihex', 'memh']:
+        print('--base requires the ihex or memh output format, or --rom')
+        sys.exit(1)
+    if (args.listing or args.map) and (args.stream or args.watch or args.numpy):
+        print('--listing and --map can\'t be used with --stream, --watch or --numpy')
+        sys.exit(1)
+    if (args.stream or args.watch) and out_format not in RECORD_FORMATS:
+        print('--stream and --watch only support the words, bytes and binary formats')
+        sys.exit(1)
+
+    if args.manifest is not None or len(args.infile) != 1 or any(c in args.infile[0] for c in '*?['):
+        if args.stream or args.watch or args.rom or args.stats or args.profile or args.listing or args.map:
+            print('--stream, --watch, --rom, --stats, --profile, --listing and --map only take a single input file')
+            sys.exit(1)
+        from batch import assemble_batch, expand_inputs
+        infiles = expand_inputs(args.infile, args.manifest)
+        if not infiles:
+            parser.error('no input files')
+        results = assemble_batch(infiles, outfile, out_format, args, args.jobs)
+        if any(result.words is None for result in results):
             sys.exit(1)
+        return
 
-    # print(ast)
-
-    # Second pass: determine addresses addresses for labels
-    address = 0
-    label_addresses = {}
-    for item in ast.value:
-        if isinstance(item.value, Label):  # found label, assign value for the following instruction
-            if item.value not in label_addresses.keys():
-                label_addresses[item.value] = address
-            else:
-                print('Error: Label {} defined more than once'.format(item.value.name))
-                sys.exit(1)
-        elif hasattr(item.value, '__iter__'):  # Found instruction, increment address
-            address += ADDRESS_INCREMENT
-
-    # print(label_addresses)
-
-    # Third pass: Generate machine code
-    address = 0
-    machine_code = []
-    for item in ast.value:
-        # Only process instructions now
-        if hasattr(item.value, '__iter__'):
-            instruction = item.value[0].value
-            arguments = [it.value for it in item.value[1:]]
-            try:
-                arguments = list(map(lambda arg: label_addresses[arg] if isinstance(arg, Label) else arg, arguments))
-            except KeyError as e:
-                missing_label = e.args[0].name
-                print('Error: Label "{}" is never defined'.format(missing_label))
-                sys.exit(1)
-            # print(arguments)
-            machine_code.append(instruction.to_machine_code(address, *arguments))
-            address += ADDRESS_INCREMENT
+    asmfile = args.infile[0]
 
-    # Write output to file
-    with open(outfile, 'w') as outfile:
-        if out_format == 'bytes':
-            # Header required for Digital to recognize hex file
-            outfile.write('v2.0 raw\n')
-            for instruction in machine_code:
-                word = '{:04x}'.format(instruction)
-                # Handle skip odd addresses argument
-                if args.skip_odd:
-                    # Write individual bytes on separate lines with zero bytes in between
-                    outfile.write('{}\n00\n{}\n00\n'.format(word[0:2], word[2:4]))
-                else:
-                    # Write individual bytes on separate lines
-                    outfile.write('{}\n{}\n'.format(word[0:2], word[2:4]))
-        elif out_format == 'words':
-            # Header required for Digital to recognize hex file
-            outfile.write('v2.0 raw\n')
-            for instruction in machine_code:
-                word = '{:04x}'.format(instruction)
-
-                # Handle skip odd addresses argument
-                if args.skip_odd:
-                    # Write each 2-byte word on its own line with zeros in between
-                    outfile.write('{}\n0000\n'.format(word))
-                else:
-                    # Write each 2-byte word on its own line
-                    outfile.write('{}\n'.format(word))
-        elif out_format == 'binary':
-            for instruction in machine_code:
-                # Write each 2-byte word on its own line in binary
-                word = '{:016b}'.format(instruction)
-                outfile.write('{}\n'.format(word))
-
-                if args.skip_odd:
-                    # write a line of zeros on odd addresses
-                    outfile.write('{:016b}\n'.format(0))
+    if outfile is None:
+        if args.rom:
+            parser.error('--rom requires the ROM image to be given with -o')
+        outfile = default_output(asmfile, out_format)
 
+    # The parser is built when it is first imported, so it is only imported if it is needed
+    if args.watch:
+        from incremental import watch
+        watch(asmfile, outfile, out_format, args.skip_odd)
+        return
 
+    if args.stream:
+        from stream import assemble_stream
+        with open(asmfile, 'r') as source, open(outfile, 'wb') as output:
+            try:
+                errors = assemble_stream(source, output, out_format, args.skip_odd, args.all_errors)
+            except AssemblyError as e:
+                errors = None
+                error_msg = 'Error: {}'.format(e)
+        if errors is None or errors:
+            # Don't leave a partly written output file behind
+            os.remove(outfile)
+        if errors is None:
+            print(error_msg)
+            sys.exit(1)
+        if errors:
+            for parse_input, error in errors:
+                parse_input.display_error(error, 4, 5)
+            if args.all_errors:
+                print('{} error{} found'.format(len(errors), '' if len(errors) == 1 else 's'))
+            sys.exit(1)
+        return
 
+    cache = open_cache(args)
+    stats = Stats(enabled=args.stats is not None or args.profile is not None, memory=not args.no_memory_stats)
+    try:
+        words, cached = assemble_file(asmfile, outfile, out_format, args, cache, args.jobs or 1, stats)
+    except AssemblyError as e:
+        display_assembly_error(e, args.all_errors)
+        sys.exit(1)
+    finally:
+        if cache is not None:
+            cache_totals = cache.save_stats()
+    if cache is not None and args.cache_stats:
+        print('Cache {}: {} hits, {} misses in total'.format('hit' if cached else 'miss', cache_totals['hits'],
+                                                            cache_totals['misses']))
+    if args.stats == 'json':
+        print(stats.to_json())
+    elif args.stats == 'text':
+        print(stats.to_text())
 
 
 if __name__ == '__main__':
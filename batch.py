@@ -0,0 +1,139 @@
+from assembler import assemble_file, default_output, display_assembly_error, open_cache
+from instructions import AssemblyError
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import glob
+import io
+from itertools import repeat
+import os
+import time
+
+# Batch mode: assemble many sources in one run, so interpreter startup and building the parser are paid once per
+# worker process instead of once per file. Files are independent, so they are spread across a process pool, and an
+# error in one file doesn't stop the others.
+
+
+# Expand the input arguments (paths or glob patterns) and the paths listed in a manifest file (one per line, relative
+# to the manifest, blank lines and lines starting with # are ignored) into a list of files.
+# Patterns that don't match anything are kept, so they are reported as missing files.
+def expand_inputs(patterns, manifest=None):
+    patterns = list(patterns)
+    if manifest is not None:
+        base = os.path.dirname(manifest)
+        with open(manifest, 'r') as manifest_file:
+            for line in manifest_file:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    patterns.append(os.path.join(base, line))
+    infiles = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if any(c in pattern for c in '*?[') else []
+        infiles.extend(matches if matches else [pattern])
+    return infiles
+
+
+# Result of assembling one file. words is None if it failed, messages holds anything that was printed.
+class BatchResult:
+    def __init__(self, infile, outfile, seconds, words, cached, messages):
+        self.infile = infile
+        self.outfile = outfile
+        self.seconds = seconds
+        self.words = words
+        self.cached = cached
+        self.messages = messages
+
+
+# Path of the output file for infile: next to it, or in outdir if given
+def batch_output(infile, outdir, out_format):
+    outfile = default_output(infile, out_format)
+    if outdir is not None:
+        outfile = os.path.join(outdir, os.path.basename(outfile))
+    return outfile
+
+
+# Assemble a single file of the batch. Runs in a worker process.
+def batch_job(infile, outfile, out_format, args):
+    start = time.perf_counter()
+    cache = open_cache(args)
+    words = None
+    cached = False
+    messages = io.StringIO()
+    # Errors are displayed into messages so the output of different files doesn't get mixed up
+    with redirect_stdout(messages):
+        try:
+            words, cached = assemble_file(infile, outfile, out_format, args, cache)
+        except AssemblyError as e:
+            display_assembly_error(e, args.all_errors)
+        except OSError as e:
+            print('Error: {}'.format(e))
+    return BatchResult(infile, outfile, time.perf_counter() - start, words, cached, messages.getvalue())
+
+
+# Assemble every file in infiles, using up to workers processes. Results are printed in the order of infiles as they
+# become available (after any files that can't be assembled because their outputs would clash). Returns the list of
+# BatchResults.
+def assemble_batch(infiles, outdir, out_format, args, workers=None):
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    start = time.perf_counter()
+
+    # Files that would be written to the same output (e.g. a/p.asm and b/p.asm with -o DIR) aren't assembled, as the
+    # workers would overwrite each other's output. They are reported first.
+    outfiles = [batch_output(infile, outdir, out_format) for infile in infiles]
+    writers = {}
+    for infile, outfile in zip(infiles, outfiles):
+        writers.setdefault(os.path.normcase(os.path.abspath(outfile)), []).append(infile)
+    results = []
+    jobs = []
+    for infile, outfile in zip(infiles, outfiles):
+        others = writers[os.path.normcase(os.path.abspath(outfile))]
+        if len(others) > 1:
+            result = BatchResult(infile, outfile, 0, None, False,
+                                 'Error: {} would be written to the same file {}'.format(', '.join(others), outfile))
+            print_result(result)
+            results.append(result)
+        else:
+            jobs.append((infile, outfile))
+    workers = min(workers, len(jobs))
+
+    job_args = ([infile for infile, outfile in jobs], [outfile for infile, outfile in jobs], repeat(out_format),
+                repeat(args))
+    if workers <= 1:
+        # Not worth starting a pool
+        for result in map(batch_job, *job_args):
+            print_result(result)
+            results.append(result)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(batch_job, *job_args):
+                print_result(result)
+                results.append(result)
+
+    failed = sum(1 for result in results if result.words is None)
+    print('{} file{} assembled, {} failed in {:.2f} s'.format(len(results) - failed, '' if len(results) - failed == 1
+                                                             else 's', failed, time.perf_counter() - start))
+    if args.cache is not None:
+        # Workers don't update the stored statistics themselves so concurrent updates can't get lost
+        cache = open_cache(args)
+        hits = sum(1 for result in results if result.cached)
+        cache.hits = hits
+        cache.misses = len(results) - hits
+        stats = cache.save_stats()
+        if args.cache_stats:
+            print('Cache: {} hits, {} misses ({} hits, {} misses in total)'.format(
+                hits, len(results) - hits, stats['hits'], stats['misses']))
+    return results
+
+
+def print_result(result):
+    if result.words is None:
+        print('{}: failed ({:.1f} ms)'.format(result.infile, result.seconds * 1000))
+    else:
+        print('{} -> {}: {} word{} ({:.1f} ms{})'.format(result.infile, result.outfile, result.words,
+                                                       '' if result.words == 1 else 's', result.seconds * 1000,
+                                                       ', cached' if result.cached else ''))
+    for line in result.messages.splitlines():
+        print('    ' + line)
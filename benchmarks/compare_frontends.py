@@ -0,0 +1,52 @@
+# Checks that the fast line-oriented front end (parse_asm_fast) produces the same machine code and the same error
+# output as the combinator parser (parse_asm) on a corpus of files, and reports how long each one took.
+# Run from the repository root: python -m benchmarks.compare_frontends FILE [FILE ...]
+from encoder import assign_label_addresses, generate_machine_code, AssemblyError
+from parser import parse_asm, parse_asm_fast, ParserInput
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+
+# Assemble text with the given front end. Returns machine code, or the error text if assembly failed.
+def assemble_with(front_end, text):
+    parse_input = ParserInput(text)
+    start = time.perf_counter()
+    ast, rem = front_end(parse_input)
+    elapsed = time.perf_counter() - start
+    if ast.error():
+        error_text = io.StringIO()
+        with contextlib.redirect_stdout(error_text):
+            parse_input.display_error(ast, 4, 5)
+        return error_text.getvalue(), elapsed
+    try:
+        return generate_machine_code(ast.value, assign_label_addresses(ast.value)), elapsed
+    except AssemblyError as e:
+        return str(e), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files', metavar='FILE', type=str, nargs='+', help='Assembly files to compare')
+    args = parser.parse_args()
+
+    mismatches = 0
+    for filename in args.files:
+        with open(filename, 'r') as f:
+            text = f.read()
+        expected, slow_time = assemble_with(parse_asm, text)
+        actual, fast_time = assemble_with(parse_asm_fast, text)
+        status = 'ok' if expected == actual else 'MISMATCH'
+        if expected != actual:
+            mismatches += 1
+        print('{:8} {:>9.4f}s {:>9.4f}s  {}'.format(status, slow_time, fast_time, filename))
+
+    print('{} of {} files differ'.format(mismatches, len(args.files)))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
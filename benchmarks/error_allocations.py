@@ -0,0 +1,47 @@
+# Compares eager and lazy error construction on a program that parses successfully.
+# Reports parse time, and (with tracemalloc) the memory each item allocates and frees again while it is parsed -
+# mostly the ParseError trees of failed alternatives - summed over the program.
+# Run from the repository root: python -m benchmarks.error_allocations [-n LINES]
+from benchmarks.parse_scaling import generate_source
+from parser import parse_asm, parse_item, ParserInput
+
+import argparse
+import time
+import tracemalloc
+
+
+def parse_time(source, lazy_errors):
+    start = time.perf_counter()
+    ast, rem = parse_asm(ParserInput(source, lazy_errors=lazy_errors))
+    assert not ast.error()
+    return time.perf_counter() - start
+
+
+# Parse one item at a time, adding up how far memory peaked above what the item left allocated
+def transient_memory(source, lazy_errors):
+    i = ParserInput(source, lazy_errors=lazy_errors)
+    transient = 0
+    tracemalloc.start()
+    while not i.at_end():
+        tracemalloc.reset_peak()
+        output, i = parse_item(i)
+        current, peak = tracemalloc.get_traced_memory()
+        transient += peak - current
+    tracemalloc.stop()
+    return transient
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, default=20000, help='Source size in lines')
+    args = parser.parse_args()
+
+    source = generate_source(args.n)
+    print('{:>8} {:>10} {:>16}'.format('errors', 'seconds', 'transient KiB'))
+    for lazy_errors in (False, True):
+        print('{:>8} {:>10.3f} {:>16.1f}'.format('lazy' if lazy_errors else 'eager', parse_time(source, lazy_errors),
+                                                 transient_memory(source, lazy_errors) / 1024))
+
+
+if __name__ == '__main__':
+    main()
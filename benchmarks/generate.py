@@ -0,0 +1,146 @@
+# Synthetic program generator for the benchmarks. Programs are built from the instruction and register tables, so they
+# exercise every instruction format the parser and encoders know about, and the mix can be varied:
+#   label_density: fraction of instructions with a label in front of them
+#   forward_ratio: fraction of branches and jumps that target a label further down (the rest go backwards)
+#   comment_density: fraction of lines that are comments or blank, or carry a trailing comment
+#   offset_syntax: fraction of lw/sw written as "lw $s1, 1($zero)" rather than "lw $s1, $zero, 1"
+# Every branch target is within range, so the programs always assemble. The same arguments and seed always give the
+# same program.
+# Run from the repository root to write a program: python -m benchmarks.generate LINES [options] > program.asm
+from instructions import Branch, JType, i_instructions, j_instructions, nop_instructions, \
+    reduced_r_instructions, r_instructions, I_IMMEDIATE, J_IMMEDIATE
+from registers import registers
+
+from bisect import bisect_left
+import argparse
+import random
+import sys
+
+# Relative weight of each kind of instruction
+INSTRUCTION_WEIGHTS = {
+    'r': 30,
+    'reduced_r': 5,
+    'i': 35,  # addi, lw and sw
+    'branch': 20,
+    'j': 5,
+    'nop': 5,
+}
+
+COMMENTS = ['# loop body', '; update counters', '# --------', '; TODO: unroll']
+
+# Branch offsets are counted from the next instruction, in instructions
+BRANCH_BACK = -I_IMMEDIATE.min - 1
+BRANCH_FORWARD = I_IMMEDIATE.max + 1
+
+
+def generate_program(lines, label_density=0.1, forward_ratio=0.5, comment_density=0.1, offset_syntax=0.5, seed=0):
+    rng = random.Random(seed)
+    kinds = list(INSTRUCTION_WEIGHTS)
+    weights = list(INSTRUCTION_WEIGHTS.values())
+    simple_i = [instruction for instruction in i_instructions if not isinstance(instruction, Branch)]
+    branches = [instruction for instruction in i_instructions if isinstance(instruction, Branch)]
+    register_names = [register.name for register in registers]
+
+    # Plan the labels up front so forward branches know what is coming. There is at most one instruction per line.
+    label_positions = [n for n in range(lines) if rng.random() < label_density]
+    label_at = set(label_positions)
+    # Jumps are absolute, so they can only reach the start of the program
+    jump_limit = bisect_left(label_positions, J_IMMEDIATE.max + 1)
+
+    # Pick a label in [low, high) instructions, or None if there isn't one
+    def pick(low, high, limit=len(label_positions)):
+        first = bisect_left(label_positions, low, 0, limit)
+        last = bisect_left(label_positions, high, 0, limit)
+        return label_positions[rng.randrange(first, last)] if first < last else None
+
+    # Pick a label for an instruction at index, preferring the direction chosen by forward_ratio
+    def target(index, back, forward, limit=len(label_positions)):
+        backward_range = (index + 1 - back, index + 1)
+        forward_range = (index + 1, index + 1 + forward)
+        ranges = [forward_range, backward_range] if rng.random() < forward_ratio else [backward_range, forward_range]
+        for low, high in ranges:
+            position = pick(low, high, limit)
+            if position is not None:
+                return position
+        return None
+
+    out = []
+    referenced = set()
+    index = 0
+    while len(out) < lines:
+        if rng.random() < comment_density:
+            choice = rng.random()
+            if choice < 0.3:
+                out.append('')
+                continue
+            elif choice < 0.6:
+                out.append(rng.choice(COMMENTS))
+                continue
+            comment = '  ' + rng.choice(COMMENTS)
+        else:
+            comment = ''
+
+        kind = rng.choices(kinds, weights)[0]
+        instruction = None
+        if kind == 'branch':
+            position = target(index, BRANCH_BACK, BRANCH_FORWARD)
+            if position is not None:
+                instruction = rng.choice(branches)
+                operands = [rng.choice(register_names), rng.choice(register_names), 'l{}'.format(position)]
+        elif kind == 'j':
+            position = target(index, index + 1, J_IMMEDIATE.max, jump_limit)
+            if position is not None:
+                instruction = rng.choice(j_instructions)
+                operands = ['l{}'.format(position)]
+        elif kind == 'r':
+            instruction = rng.choice(r_instructions)
+            operands = [rng.choice(register_names) for _ in range(3)]
+        elif kind == 'reduced_r':
+            instruction = rng.choice(reduced_r_instructions)
+            operands = [rng.choice(register_names) for _ in range(2)]
+        elif kind == 'nop':
+            instruction = rng.choice(nop_instructions)
+            operands = []
+        if instruction is None:  # 'i', or a branch or jump without a label in range
+            instruction = rng.choice(simple_i)
+            rt, rs = rng.choice(register_names), rng.choice(register_names)
+            immediate = rng.randint(I_IMMEDIATE.min, I_IMMEDIATE.max)
+            if instruction.name in ('lw', 'sw') and rng.random() < offset_syntax:
+                operands = [rt, '{}({})'.format(immediate, rs)]
+            else:
+                operands = [rt, rs, str(immediate)]
+        if isinstance(instruction, (Branch, JType)):
+            referenced.add(position)
+
+        text = '    ' + instruction.name
+        if operands:
+            text += ' ' + ', '.join(operands)
+        if index in label_at:
+            text = 'l{}:{}'.format(index, text if rng.random() < 0.5 else '\n' + text)
+        out.append(text + comment)
+        index += 1
+
+    # Forward references to planned labels past the end of the program are defined at the end
+    for position in sorted(referenced):
+        if position >= index:
+            out.append('l{}:'.format(position))
+    return '\n'.join(out) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lines', metavar='LINES', type=int, help='Program size in lines')
+    parser.add_argument('--label_density', type=float, default=0.1, help='Fraction of instructions with a label')
+    parser.add_argument('--forward_ratio', type=float, default=0.5, help='Fraction of branches going forwards')
+    parser.add_argument('--comment_density', type=float, default=0.1,
+                        help='Fraction of lines that are blank, comments or have a trailing comment')
+    parser.add_argument('--offset_syntax', type=float, default=0.5,
+                        help='Fraction of lw/sw using the offset($register) syntax')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.stdout.write(generate_program(args.lines, args.label_density, args.forward_ratio, args.comment_density,
+                                      args.offset_syntax, args.seed))
+
+
+if __name__ == '__main__':
+    main()
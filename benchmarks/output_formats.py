@@ -0,0 +1,47 @@
+# Compares writing one formatted record per instruction (the original output loop) with rendering the whole file from
+# lookup tables and writing it at once, for the Digital text formats with and without --skip_odd.
+# Run from the repository root: python -m benchmarks.output_formats [-n WORDS]
+from output import format_word, write_machine_code, HEADERS, RECORD_FORMATS
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+
+def per_word(outfile, machine_code, out_format, skip_odd):
+    outfile.write(HEADERS[out_format])
+    for instruction in machine_code:
+        outfile.write(format_word(instruction, out_format, skip_odd))
+
+
+def time_write(write, path, machine_code, out_format, skip_odd):
+    start = time.perf_counter()
+    with open(path, 'w') as outfile:
+        write(outfile, machine_code, out_format, skip_odd)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='WORDS', type=int, default=1000000, help='Image size in words')
+    args = parser.parse_args()
+
+    machine_code = [random.randrange(0x10000) for _ in range(args.n)]
+    with tempfile.TemporaryDirectory() as directory:
+        old_path = os.path.join(directory, 'per_word')
+        new_path = os.path.join(directory, 'bulk')
+        print('{:>8} {:>9} {:>10} {:>10} {:>8}'.format('format', 'skip_odd', 'per word', 'bulk', 'speedup'))
+        for out_format in RECORD_FORMATS:
+            for skip_odd in (False, True):
+                old = time_write(per_word, old_path, machine_code, out_format, skip_odd)
+                # The first bulk write of a format builds its lookup table, which is included
+                new = time_write(write_machine_code, new_path, machine_code, out_format, skip_odd)
+                with open(old_path) as old_file, open(new_path) as new_file:
+                    assert old_file.read() == new_file.read()
+                print('{:>8} {:>9} {:>9.3f}s {:>9.3f}s {:>7.1f}x'.format(out_format, str(skip_odd), old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# Compares serial assembly of one large source with splitting it into chunks that are assembled in worker processes.
+# The speedup depends on the number of CPUs; with a single CPU the parallel run only shows the overhead.
+# Run from the repository root: python -m benchmarks.parallel_chunks [-n LINES] [-j WORKERS ...]
+from benchmarks.parse_scaling import generate_source
+from parallel import assemble_parallel, assemble_serial
+
+import argparse
+import os
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, default=300000, help='Source size in lines')
+    parser.add_argument('-j', metavar='WORKERS', type=int, nargs='+', default=[2, 4, os.cpu_count() or 1],
+                        help='Worker counts to time')
+    args = parser.parse_args()
+
+    source = generate_source(args.n)
+    start = time.perf_counter()
+    expected = assemble_serial(source, True, False)
+    serial = time.perf_counter() - start
+    print('{:>8} {:>8.3f}s'.format('serial', serial))
+
+    for workers in sorted(set(args.j)):
+        start = time.perf_counter()
+        result = assemble_parallel(source, workers)
+        elapsed = time.perf_counter() - start
+        assert result == expected
+        print('{:>8} {:>8.3f}s {:>6.2f}x'.format('-j {}'.format(workers), elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# Measures how parse time grows with source size. Parsing matches in place, so time per line should stay flat.
+# Run from the repository root: python -m benchmarks.parse_scaling [-n 1000 10000 ...]
+from parser import parse_asm, ParserInput
+
+import argparse
+import time
+
+# One block of representative source, repeated to build programs of any size
+TEMPLATE = [
+    'loop{n}: add $s2, $s0, $s1   ; r-type',
+    '    addi $s0, $zero, -1',
+    '    bne $s0, $zero, skip{n}',
+    '    nop',
+    '# comment line',
+    '    lw $s1, 1 ($zero)',
+    'skip{n}: asl1 $s2, $s2',
+    '    blt $s0, $zero, loop{n}',
+    '    j loop0',
+]
+
+
+def generate_source(lines):
+    out = []
+    n = 0
+    while len(out) < lines:
+        out.extend(line.format(n=n) for line in TEMPLATE)
+        n += 1
+    return '\n'.join(out) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help='Source sizes (in lines) to parse')
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>12}'.format('lines', 'seconds', 'us/line'))
+    for lines in args.n:
+        source = generate_source(lines)
+        start = time.perf_counter()
+        ast, rem = parse_asm(ParserInput(source))
+        elapsed = time.perf_counter() - start
+        assert not ast.error()
+        print('{:>10} {:>10.3f} {:>12.2f}'.format(lines, elapsed, elapsed / lines * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Compares the single-pass Assembler (with a forward-reference fixup table) against the original three-pass flow
+# (parse, assign_label_addresses, generate_machine_code) on programs where most branches go forwards.
+# Both are timed on the same parsed program; parsing itself isn't included.
+# Run from the repository root: python -m benchmarks.single_pass [-n LINES]
+from encoder import Assembler, assign_label_addresses, generate_machine_code
+from parser import parse_asm_fast, ParserInput
+
+import argparse
+import time
+
+# Every branch in a block except the last one targets a label further down. (Jumps are left out because their 13-bit
+# absolute target can't reach most of a large program.)
+TEMPLATE = [
+    'block{n}: addi $s0, $s0, 1',
+    '    bne $s0, $zero, a{n}',
+    '    blt $s0, $s1, b{n}',
+    '    bne $s3, $s4, c{n}',
+    'a{n}: add $s2, $s0, $s1',
+    '    bne $s2, $zero, c{n}',
+    'b{n}: lw $s1, 1($zero)',
+    '    blt $s1, $s0, block{m}',
+    'c{n}: sw $s1, 0($s2)',
+]
+
+
+def generate_source(lines):
+    out = []
+    n = 0
+    while len(out) < lines:
+        out.extend(line.format(n=n, m=n + 1) for line in TEMPLATE)
+        n += 1
+    out.append('block{}: nop'.format(n))
+    return '\n'.join(out) + '\n'
+
+
+def three_pass(items):
+    return generate_machine_code(items, assign_label_addresses(items))
+
+
+def single_pass(items):
+    assembler = Assembler()
+    assembler.add_all(items)
+    return assembler.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, default=200000, help='Source size in lines')
+    parser.add_argument('-r', metavar='REPEAT', type=int, default=5, help='Number of timing runs (best is reported)')
+    args = parser.parse_args()
+
+    ast, rem = parse_asm_fast(ParserInput(generate_source(args.n)))
+    assert not ast.error()
+
+    results = {}
+    for name, fn in (('three-pass', three_pass), ('single-pass', single_pass)):
+        best = None
+        for _ in range(args.r):
+            start = time.perf_counter()
+            results[name] = fn(ast.value)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('{:>12} {:>8.3f}s'.format(name, best))
+    assert results['three-pass'] == results['single-pass']
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Measures the startup cost of the command line assembler on a tiny program, where startup is nearly all of the run
+# time. Each run is a fresh interpreter; the time of "python -c pass" is subtracted to get the assembler's own share.
+# The slowest imports of one run are listed from python -X importtime.
+# Run from the repository root: python -m benchmarks.startup [-r RUNS] [-- ASSEMBLER OPTIONS]
+from benchmarks.generate import generate_program
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def best_run_time(command, runs, env):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Returns [(cumulative microseconds, module)] for the modules imported directly by the run (not by other modules)
+def top_level_imports(command, env):
+    result = subprocess.run(command[:1] + ['-X', 'importtime'] + command[1:], env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # Nested imports are indented
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, default=10, help='Program size in lines')
+    parser.add_argument('-r', metavar='RUNS', type=int, default=20, help='Number of runs (best is reported)')
+    parser.add_argument('--top', metavar='N', type=int, default=10, help='Number of imports to list')
+    parser.add_argument('options', nargs='*', help='Options for assembler.py (after --)')
+    args = parser.parse_args()
+
+    # Like a real installation, keep the bytecode cache so modules aren't recompiled on every run
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'program.asm')
+        with open(source, 'w') as source_file:
+            source_file.write(generate_program(args.n))
+        command = [sys.executable, 'assembler.py', source, '-o', os.path.join(directory, 'program.hex')]
+        command += args.options
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)  # Write the bytecode cache
+
+        interpreter = best_run_time([sys.executable, '-c', 'pass'], args.r, env)
+        assembler = best_run_time(command, args.r, env)
+        print('python -c pass: {:8.1f} ms'.format(interpreter * 1000))
+        print('assembler.py:   {:8.1f} ms ({:.1f} ms more than the bare interpreter)'.format(
+            assembler * 1000, (assembler - interpreter) * 1000))
+        print()
+        print('Slowest imports (cumulative ms):')
+        for cumulative, name in top_level_imports(command, env)[:args.top]:
+            print('{:>8.1f}  {}'.format(cumulative / 1000, name))
+
+
+if __name__ == '__main__':
+    main()
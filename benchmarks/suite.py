@@ -0,0 +1,148 @@
+# Times every stage of assembly on synthetic programs (see benchmarks/generate.py) of several sizes and shapes:
+#   parse: ParserInput and parse_asm (the combinator parser)
+#   parse_fast: parse_asm_fast (the line-oriented front end)
+#   labels: assign_label_addresses
+#   encode: generate_machine_code (to_machine_code for every instruction)
+#   single_pass: the Assembler used by the command line (labels, encoding and fixups)
+#   write_FORMAT: write_machine_code into memory, for every output format
+# Each stage is run several times and the fastest run is kept. The results can be saved as a JSON baseline and later
+# runs compared against it: a stage that got slower by more than the threshold is reported as a regression and the
+# exit status is 1.
+# Run from the repository root: python -m benchmarks.suite [-n 1000 10000 ...] [--save FILE] [--compare FILE]
+from benchmarks.generate import generate_program
+from encoder import Assembler, assign_label_addresses, generate_machine_code
+from output import FORMATS, OUTPUT_FORMATS, write_machine_code
+from parser import parse_asm, parse_asm_fast, ParserInput
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+
+BASELINE_VERSION = 1
+
+# Program shapes: keyword arguments for generate_program
+PROGRAMS = {
+    'default': {},
+    'dense_labels': {'label_density': 0.5},
+    'forward': {'forward_ratio': 1.0},
+    'backward': {'forward_ratio': 0.0},
+    'comments': {'comment_density': 0.5},
+    'offset_syntax': {'offset_syntax': 1.0},
+}
+
+# Stages faster than this are too noisy to compare
+MIN_COMPARE_SECONDS = 0.001
+
+
+def best_time(function, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def single_pass(items):
+    assembler = Assembler()
+    assembler.add_all(items)
+    return assembler.finish()
+
+
+# Time every stage on one program. Returns {stage: seconds}.
+def run_stages(source, repeat, slow_parser=True):
+    times = {}
+    if slow_parser:
+        times['parse'], (ast, rem) = best_time(lambda: parse_asm(ParserInput(source)), repeat)
+        assert not ast.error()
+    times['parse_fast'], (ast, rem) = best_time(lambda: parse_asm_fast(ParserInput(source)), repeat)
+    assert not ast.error()
+    items = ast.value
+    times['labels'], label_addresses = best_time(lambda: assign_label_addresses(items), repeat)
+    times['encode'], machine_code = best_time(lambda: generate_machine_code(items, label_addresses), repeat)
+    times['single_pass'], single_pass_code = best_time(lambda: single_pass(items), repeat)
+    assert single_pass_code == machine_code
+    for out_format in OUTPUT_FORMATS:
+        def write():
+            outfile = io.BytesIO() if FORMATS[out_format].binary else io.StringIO()
+            write_machine_code(outfile, machine_code, out_format, False)
+        times['write_' + out_format], _ = best_time(write, repeat)
+    return times
+
+
+# Run the suite. Returns {'programs/size/stage': seconds}.
+def run_suite(sizes, programs, repeat, slow_parser_limit):
+    results = {}
+    for name in programs:
+        for lines in sizes:
+            source = generate_program(lines, **PROGRAMS[name])
+            times = run_stages(source, repeat, lines <= slow_parser_limit)
+            for stage, seconds in times.items():
+                key = '{}/{}/{}'.format(name, lines, stage)
+                results[key] = seconds
+                print('{:<40} {:>10.2f} ms {:>10.3f} us/line'.format(key, seconds * 1000, seconds / lines * 1e6))
+    return results
+
+
+# Compare results with a baseline. Returns the list of (key, old seconds, new seconds) that got slower by more than
+# threshold (a fraction, 0.1 is 10%).
+def compare(results, baseline, threshold):
+    regressions = []
+    print()
+    print('{:<40} {:>11} {:>11} {:>8}'.format('stage', 'baseline', 'now', 'change'))
+    for key, seconds in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        change = seconds / old - 1 if old > 0 else 0
+        regressed = change > threshold and max(old, seconds) >= MIN_COMPARE_SECONDS
+        if regressed:
+            regressions.append((key, old, seconds))
+        print('{:<40} {:>8.2f} ms {:>8.2f} ms {:>+7.1f}%{}'.format(key, old * 1000, seconds * 1000, change * 100,
+                                                                  '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', metavar='LINES', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Program sizes in lines (up to 1000000)')
+    parser.add_argument('-p', '--programs', metavar='NAME', nargs='+', choices=list(PROGRAMS), default=list(PROGRAMS),
+                        help='Program shapes to run: ' + ', '.join(PROGRAMS))
+    parser.add_argument('-r', metavar='REPEAT', type=int, default=3, help='Number of timing runs (best is kept)')
+    parser.add_argument('--slow_parser_limit', metavar='LINES', type=int, default=100000,
+                        help="Don't time the combinator parser on programs bigger than this")
+    parser.add_argument('--save', metavar='FILE', type=str, help='Save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', type=str, help='Compare the results with a saved baseline')
+    parser.add_argument('--threshold', metavar='PERCENT', type=float, default=10,
+                        help='Slowdown (in percent) reported as a regression, default 10')
+    args = parser.parse_args()
+
+    results = run_suite(args.n, args.programs, args.r, args.slow_parser_limit)
+
+    if args.save is not None:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'version': BASELINE_VERSION, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'results': results}, baseline_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('version') != BASELINE_VERSION:
+            print('Baseline {} was saved by a different version of the suite'.format(args.compare))
+            sys.exit(2)
+        regressions = compare(results, baseline['results'], args.threshold / 100)
+        if regressions:
+            print('{} stage{} slower by more than {}%'.format(len(regressions), '' if len(regressions) == 1 else 's',
+                                                               args.threshold))
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
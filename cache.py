@@ -0,0 +1,141 @@
+from image import MemoryImage, Segment
+from instructions import all_instructions, ADDRESS_INCREMENT, OPERAND_VALUE
+from registers import registers
+
+from array import array
+import hashlib
+import json
+import os
+import tempfile
+
+# On-disk cache of assembled programs, for repeatedly assembling mostly unchanged sources (e.g. in CI).
+# Entries are keyed by the source bytes plus a fingerprint of the instruction set, so changing an instruction,
+# register or field layout invalidates every entry. Each entry holds the machine code and the label addresses, so a hit
+# skips parsing and encoding entirely. The least recently used entries are removed once the cache is over its size
+# limit.
+
+# Change this when the assembler's output changes for the same source and instruction set
+CACHE_VERSION = 2
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024  # Bytes
+
+STATS_FILE = 'stats.json'
+ENTRY_SUFFIX = '.entry'
+
+
+# Hash of everything in instructions.py and registers.py that affects the machine code
+def isa_fingerprint():
+    description = [CACHE_VERSION, ADDRESS_INCREMENT, sorted(OPERAND_VALUE.items())]
+    for instruction in all_instructions:
+        description.append([instruction.name, type(instruction).__name__, instruction.base_word,
+                            instruction.format.name, instruction.format.operands,
+                            [(f.name, f.width, f.position, f.signed) for f in instruction.format.fields.values()]])
+    description.append([(register.name, register.address) for register in registers])
+    return hashlib.sha256(json.dumps(description).encode('utf-8')).hexdigest()
+
+
+class AssemblyCache:
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.fingerprint = isa_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    # variant names the options the machine code was assembled with, if they change it
+    def key(self, source, variant=''):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        return hashlib.sha256((self.fingerprint + variant).encode('ascii') + source).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    # Returns (MemoryImage, {label name: address}) for the source, or None if it isn't cached
+    def get(self, source, variant=''):
+        path = self.entry_path(self.key(source, variant))
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Entry layout: segment count (4 bytes), then the address and word count (4 bytes each) and the words (2 bytes
+        # each) of every segment, then the labels as JSON
+        try:
+            segments = []
+            offset = 4
+            for _ in range(int.from_bytes(data[:4], 'little')):
+                address = int.from_bytes(data[offset:offset + 4], 'little')
+                count = int.from_bytes(data[offset + 4:offset + 8], 'little')
+                offset += 8
+                if len(data) < offset + 2 * count:
+                    raise ValueError('truncated entry')
+                words = array('H')
+                words.frombytes(data[offset:offset + 2 * count])
+                segments.append(Segment(address, words))
+                offset += 2 * count
+            labels = json.loads(data[offset:].decode('utf-8'))
+        except ValueError:
+            self.misses += 1  # Damaged entry, it is replaced when the source is assembled again
+            return None
+        os.utime(path)  # Mark as recently used
+        self.hits += 1
+        return MemoryImage(segments), labels
+
+    def put(self, source, image, labels, variant=''):
+        parts = [len(image.segments).to_bytes(4, 'little')]
+        for segment in image.segments:
+            parts += [segment.address.to_bytes(4, 'little'), len(segment.words).to_bytes(4, 'little'),
+                      segment.words.tobytes()]
+        parts.append(json.dumps(labels).encode('utf-8'))
+        self.write_atomic(self.entry_path(self.key(source, variant)), b''.join(parts))
+        self.evict()
+
+    # Write to a temporary file and rename it, so concurrent runs never see a partial file
+    def write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    # Remove least recently used entries until the cache fits in max_size
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(ENTRY_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass  # Already evicted by another run
+            total -= size
+
+    # Add this run's hits and misses to the totals stored in the cache directory and return the totals
+    def save_stats(self):
+        stats = self.load_stats()
+        stats['hits'] += self.hits
+        stats['misses'] += self.misses
+        self.write_atomic(os.path.join(self.directory, STATS_FILE), json.dumps(stats).encode('utf-8'))
+        self.hits = 0
+        self.misses = 0
+        return stats
+
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.directory, STATS_FILE), 'r') as stats_file:
+                return json.load(stats_file)
+        except (FileNotFoundError, ValueError):
+            return {'hits': 0, 'misses': 0}
@@ -0,0 +1,222 @@
+from image import Data, DataWord, MemoryImage, Org, Space
+from instructions import ADDRESS_INCREMENT, AssemblyError
+from parser import Label
+
+
+# Address of the item after a data directive (.org, .space or data) at address
+def directive_end(directive, address):
+    if isinstance(directive, Org):
+        return directive.address
+    elif isinstance(directive, Space):
+        return address + directive.size
+    return address + len(directive.words) * ADDRESS_INCREMENT
+
+
+# Second pass: determine addresses for labels
+def assign_label_addresses(items):
+    address = 0
+    label_addresses = {}
+    for item in items:
+        if isinstance(item.value, Label):  # found label, assign value for the following instruction
+            if item.value not in label_addresses.keys():
+                label_addresses[item.value] = address
+            else:
+                raise AssemblyError('Label {} defined more than once'.format(item.value.name))
+        elif hasattr(item.value, '__iter__'):  # Found instruction, increment address
+            address += ADDRESS_INCREMENT
+        else:
+            address = directive_end(item.value, address)
+    return label_addresses
+
+
+# Third pass: Generate machine code. Returns the words in the order of the items (see Assembler.image for their
+# addresses).
+def generate_machine_code(items, label_addresses):
+    address = 0
+    machine_code = []
+    for item in items:
+        # Only process instructions now
+        if hasattr(item.value, '__iter__'):
+            instruction = item.value[0].value
+            arguments = [it.value for it in item.value[1:]]
+            try:
+                arguments = list(map(lambda arg: label_addresses[arg] if isinstance(arg, Label) else arg, arguments))
+            except KeyError as e:
+                missing_label = e.args[0].name
+                raise AssemblyError('Label "{}" is never defined'.format(missing_label))
+            # print(arguments)
+            machine_code.append(instruction.to_machine_code(address, *arguments))
+            address += ADDRESS_INCREMENT
+        elif isinstance(item.value, Data):
+            for word in item.value.words:
+                if isinstance(word, Label):
+                    if word not in label_addresses:
+                        raise AssemblyError('Label "{}" is never defined'.format(word.name))
+                    word = DataWord.to_machine_code(address, label_addresses[word])
+                machine_code.append(word)
+                address += ADDRESS_INCREMENT
+        elif not isinstance(item.value, Label):
+            address = directive_end(item.value, address)
+    return machine_code
+
+
+# Assembles items in a single pass, as they are parsed.
+# Instructions are encoded as soon as they are added. If one uses a label that hasn't been defined yet, a placeholder
+# word is written and the instruction is added to a fixup table keyed by that label. The table is patched once all
+# labels are known.
+# Words are appended to machine_code, which can be a list or any other sink supporting append() and item assignment.
+# Data directives can move the address, so machine_code is made of runs of consecutive words: runs holds the address
+# and index in machine_code of the first word of each, and image() returns them as a MemoryImage.
+# If a source_map is given (see listing.py), the address and source location of every item is recorded in it as the
+# item is encoded.
+class Assembler:
+    def __init__(self, machine_code=None, source_map=None):
+        self.machine_code = machine_code if machine_code is not None else []
+        self.source_map = source_map
+        self.label_addresses = {}
+        self.address = 0
+        self.count = 0  # Number of words added so far
+        self.fixups = {}  # Label -> [(index, address, instruction, arguments)] of instructions waiting for it
+        self.runs = [(0, 0)]  # [(address, index)]
+
+    def add(self, item):
+        self.add_all((item,))
+
+    def add_all(self, items):
+        label_addresses = self.label_addresses
+        fixups = self.fixups
+        append = self.machine_code.append
+        address = self.address
+        count = self.count
+        source_map = self.source_map
+        if source_map is not None:
+            map_address = source_map.addresses.append
+            map_offset = source_map.offsets.append
+        for item in items:
+            value = item.value
+            if isinstance(value, Label):
+                if value in label_addresses:
+                    raise AssemblyError('Label {} defined more than once'.format(value.name))
+                label_addresses[value] = address
+            elif hasattr(value, '__iter__'):
+                if source_map is not None:
+                    map_address(address)
+                    map_offset(item.loc)
+                instruction = value[0].value
+                arguments = [it.value for it in value[1:]]
+                # The grammar allows at most one label per instruction, always the last argument
+                label = arguments[-1] if arguments else None
+                if isinstance(label, Label):
+                    target = label_addresses.get(label)
+                    if target is None:
+                        # Forward reference, encode it once the label is defined
+                        fixups.setdefault(label, []).append((count, address, instruction, arguments))
+                        append(0)
+                        address += ADDRESS_INCREMENT
+                        count += 1
+                        continue
+                    arguments[-1] = target
+                append(instruction.to_machine_code(address, *arguments))
+                address += ADDRESS_INCREMENT
+                count += 1
+            else:
+                if source_map is not None:
+                    if isinstance(value, Data):
+                        map_address(address)
+                        map_offset(item.loc)
+                    else:
+                        source_map.gap(address)
+                self.address = address
+                self.count = count
+                self.add_directive(value)
+                address = self.address
+                count = self.count
+        self.address = address
+        self.count = count
+
+    def add_directive(self, directive):
+        if isinstance(directive, Data):
+            words = directive.words
+            if isinstance(words, list) and any(isinstance(word, Label) for word in words):
+                words = list(words)
+                for n, word in enumerate(words):
+                    if isinstance(word, Label):
+                        address = self.address + n * ADDRESS_INCREMENT
+                        target = self.label_addresses.get(word)
+                        if target is None:
+                            self.fixups.setdefault(word, []).append((self.count + n, address, DataWord, [word]))
+                            words[n] = 0
+                        else:
+                            words[n] = DataWord.to_machine_code(address, target)
+            self.machine_code.extend(words)
+            self.address += len(words) * ADDRESS_INCREMENT
+            self.count += len(words)
+        else:
+            self.address = directive_end(directive, self.address)
+            if self.runs[-1][1] == self.count:
+                self.runs[-1] = (self.address, self.count)  # Nothing was added since the last one
+            else:
+                self.runs.append((self.address, self.count))
+
+    # The machine code as a MemoryImage (call finish() first). Raises AssemblyError if parts of it overlap.
+    def image(self):
+        if len(self.runs) == 1:
+            return MemoryImage.from_words(self.machine_code, self.runs[0][0])
+        ends = [index for address, index in self.runs[1:]] + [self.count]
+        return MemoryImage.from_runs((address, self.machine_code[start:end])
+                                     for (address, start), end in zip(self.runs, ends))
+
+    # Patch every instruction that used a forward reference. Returns the machine code.
+    def finish(self):
+        if self.source_map is not None:
+            self.source_map.gap(self.address)
+            self.source_map.set_labels(self.label_addresses)
+        for label, fixups in self.fixups.items():
+            target = self.label_addresses.get(label)
+            if target is None:
+                raise AssemblyError('Label "{}" is never defined'.format(label.name))
+            for index, address, instruction, arguments in fixups:
+                arguments[-1] = target
+                self.machine_code[index] = instruction.to_machine_code(address, *arguments)
+        self.fixups = {}
+        return self.machine_code
+
+
+# Raised by assemble() when the source can't be parsed.
+# parse_input.display_error(error, ...) prints the detailed error. path is the file the error is in if it isn't the
+# file being assembled (e.g. an included file).
+class AssemblySyntaxError(AssemblyError):
+    def __init__(self, parse_input, error, path=None):
+        line_no, column = parse_input.lines.line_col(error.loc)
+        super().__init__('{}({},{}): Expected {}'.format('' if path is None else path + ': ', line_no, column,
+                                                          error.error_msg))
+        self.parse_input = parse_input
+        self.error = error
+        self.path = path
+
+
+# Assemble source text. Returns the machine code (a list of words from address 0, with zeros in the gaps left by .org
+# and .space) and the address of every label.
+# path is the file the text was read from, if any: .include directives are relative to it. relax rewrites branches
+# that are out of range (see relax.py) and optimize runs the peephole optimizer (see optimize.py) first. If a
+# source_map is given (a listing.SourceMap), the source location of every word is recorded in it.
+# Raises AssemblySyntaxError if the source can't be parsed and AssemblyError for label errors.
+def assemble(text, fast=True, path=None, relax=False, optimize=False, source_map=None):
+    image, label_addresses = assemble_image(text, fast, path, relax, optimize, source_map)
+    return image.dense().tolist(), label_addresses
+
+
+# The same, but returns the machine code as a MemoryImage, without filling in the gaps left by .org and .space
+def assemble_image(text, fast=True, path=None, relax=False, optimize=False, source_map=None):
+    from preprocessor import Preprocessor
+    items = Preprocessor(fast).process(text, path)
+    if optimize:
+        from optimize import optimize_items
+        items, removed = optimize_items(items)
+    if relax:
+        from relax import relax_branches
+        items, relaxed = relax_branches(items)
+    assembler = Assembler(source_map=source_map)
+    assembler.add_all(items)
+    assembler.finish()
+    return assembler.image(), {label.name: address for label, address in assembler.label_addresses.items()}
@@ -0,0 +1,148 @@
+from instructions import ADDRESS_INCREMENT, AssemblyError
+
+from array import array
+from bisect import bisect_right
+import sys
+
+# Sparse memory image of an assembled program: a sorted list of segments, each a run of consecutive words starting at
+# some address. Gaps between segments (left by .org and .space) aren't stored anywhere, so a table at 0x4000 after a
+# short program is two small segments rather than 8k words of padding. Writers that need every address fill the gaps
+# with zeros a whole gap at a time.
+
+WORD_MIN = -(1 << 15)
+WORD_MAX = (1 << 16) - 1
+
+
+# Run of consecutive words starting at a byte address
+class Segment:
+    __slots__ = ('address', 'words')
+
+    def __init__(self, address, words):
+        self.address = address
+        self.words = words  # array('H')
+
+    def __repr__(self):
+        return 'Segment(0x{:04x}, {} words)'.format(self.address, len(self.words))
+
+    # Address after the last word
+    def end(self):
+        return self.address + len(self.words) * ADDRESS_INCREMENT
+
+
+class MemoryImage:
+    def __init__(self, segments=None):
+        self.segments = segments if segments is not None else []  # Sorted by address, never overlapping
+
+    def __repr__(self):
+        return 'MemoryImage({})'.format(self.segments)
+
+    def __eq__(self, other):
+        return isinstance(other, MemoryImage) and [(s.address, s.words) for s in self.segments] == \
+            [(s.address, s.words) for s in other.segments]
+
+    # Number of words stored (not counting gaps)
+    def __len__(self):
+        return sum(len(segment.words) for segment in self.segments)
+
+    # Image of a program without any gaps: the words starting at address
+    @staticmethod
+    def from_words(words, address=0):
+        return MemoryImage([Segment(address, array('H', words))] if len(words) else [])
+
+    # Image of runs of words: [(address, words)] in any order. Empty runs are dropped.
+    # Raises AssemblyError if two runs overlap.
+    @staticmethod
+    def from_runs(runs):
+        segments = sorted((Segment(address, words if isinstance(words, array) else array('H', words))
+                           for address, words in runs if len(words)), key=lambda segment: segment.address)
+        for previous, segment in zip(segments, segments[1:]):
+            if segment.address < previous.end():
+                raise AssemblyError('Words at 0x{:04x} to 0x{:04x} overlap words at 0x{:04x} to 0x{:04x}'.format(
+                    segment.address, segment.end() - ADDRESS_INCREMENT, previous.address,
+                    previous.end() - ADDRESS_INCREMENT))
+        return MemoryImage(segments)
+
+    # The segment holding the word at address (which must be in one)
+    def segment(self, address):
+        return self.segments[bisect_right(self.segments, address, key=lambda segment: segment.address) - 1]
+
+    # Address after the last word, 0 if the image is empty
+    def end(self):
+        return self.segments[-1].end() if self.segments else 0
+
+    # [(gap, segment)] for every segment, where gap is the number of unused words before it (from address 0)
+    def runs(self):
+        runs = []
+        address = 0
+        for segment in self.segments:
+            runs.append(((segment.address - address) // ADDRESS_INCREMENT, segment))
+            address = segment.end()
+        return runs
+
+    # Every word from address 0 to the end as one array('H'), with zeros in the gaps
+    def dense(self):
+        if len(self.segments) == 1 and self.segments[0].address == 0:
+            return self.segments[0].words
+        words = array('H')
+        for gap, segment in self.runs():
+            words.frombytes(bytes(gap * words.itemsize))
+            words.extend(segment.words)
+        return words
+
+
+# Items added by the data directives (see preprocessor.py), next to the Labels and instructions the parser produces
+
+# .org ADDRESS: the following items start at address
+class Org:
+    __slots__ = ('address',)
+
+    def __init__(self, address):
+        self.address = address
+
+    def __repr__(self):
+        return 'Org(0x{:04x})'.format(self.address)
+
+
+# .space SIZE: skip size bytes (left as a gap, so they read as zero)
+class Space:
+    __slots__ = ('size',)
+
+    def __init__(self, size):
+        self.size = size
+
+    def __repr__(self):
+        return 'Space({})'.format(self.size)
+
+
+# .word, .fill and .incbin: words stored as they are. words is an array('H'), or a list that may also hold Labels
+# (replaced by their addresses).
+class Data:
+    __slots__ = ('words',)
+
+    def __init__(self, words):
+        self.words = words
+
+    def __repr__(self):
+        return 'Data({} words)'.format(len(self.words))
+
+
+# Encodes a .word that refers to a label, like an instruction with a single operand so the Assembler can patch forward
+# references to it the same way
+class DataWord:
+    name = '.word'
+
+    @staticmethod
+    def to_machine_code(address, value):
+        if not WORD_MIN <= value <= WORD_MAX:
+            raise AssemblyError('.word at address {}: {} does not fit in 16 bits'.format(address, value))
+        return value & 0xFFFF
+
+
+# Words of raw bytes (.incbin), big-endian like the bytes and ihex formats. An odd number of bytes is padded with a
+# zero byte.
+def words_from_bytes(data):
+    words = array('H')
+    words.frombytes(data + bytes(len(data) % 2))
+    if sys.byteorder != 'big':
+        words.byteswap()
+    return words
@@ -0,0 +1,165 @@
+from encoder import AssemblyError, AssemblySyntaxError
+from instructions import ADDRESS_INCREMENT, PC_RELATIVE
+from output import RecordWriter
+from parser import parse_asm_fast, fast_skip_pattern, Label, LineIndex, ParseResult, ParserInput
+
+import os
+import time
+
+
+# Incremental re-assembly for edit/save loops.
+# The parse of every line is cached by its text, so after an edit only new or changed lines are parsed. Label
+# addresses are only recomputed from the first changed line onward, and encoded words are cached by everything they
+# depend on (the line, the address for PC-relative instructions and the label target), so only instructions whose
+# operands or addresses changed are re-encoded. Like --stream, every instruction and label must fit on a single line.
+class IncrementalAssembler:
+    def __init__(self):
+        self.parse_cache = {}  # Line text -> ParseResult with the line's items, or a ParseError
+        self.encode_cache = {}  # (line, item index, address or None, target or None) -> instruction word
+        self.lines = []
+        # Address of the first instruction at or after the start of each line, and the address after the last line
+        self.line_addresses = []
+        self.label_lines = {}  # Label -> index of the line defining it
+        self.label_addresses = {}
+        self.machine_code = []
+        # Work done by the last update
+        self.parsed = 0
+        self.encoded = 0
+
+    def parse_line(self, line):
+        result = self.parse_cache.get(line)
+        if result is None:
+            if fast_skip_pattern.match(line).end() == len(line):
+                result = ParseResult(len(line), [])  # Blank or comment-only line
+            else:
+                result, rem = parse_asm_fast(ParserInput(line, lazy_errors=True))
+            self.parse_cache[line] = result
+            self.parsed += 1
+        return result
+
+    # Re-assemble after the source changed to text. Returns the indexes of the instruction words that changed
+    # (including new ones); the machine code is in self.machine_code.
+    # Raises AssemblySyntaxError or AssemblyError and keeps the previous state if the new source has errors.
+    def update(self, text):
+        self.parsed = 0
+        self.encoded = 0
+        lines = text.splitlines(keepends=True)
+
+        # Everything before the first changed line keeps its addresses
+        first = 0
+        while first < len(lines) and first < len(self.lines) and lines[first] == self.lines[first]:
+            first += 1
+
+        results = []
+        for line_no, line in enumerate(lines):
+            result = self.parse_line(line)
+            if result.error():
+                # Re-parse with the line number so the error points at the right line
+                parse_input = ParserInput(line, lines=LineIndex(line, first_line=line_no + 1))
+                error, rem = parse_asm_fast(parse_input)
+                raise AssemblySyntaxError(parse_input, error)
+            results.append(result.value)
+
+        # Labels and line addresses before the first changed line are kept, the rest are recomputed
+        label_lines = {label: line_no for label, line_no in self.label_lines.items() if line_no < first}
+        label_addresses = {label: self.label_addresses[label] for label in label_lines}
+        line_addresses = self.line_addresses[:first]
+        address = self.line_addresses[first] if first < len(self.line_addresses) else 0
+        for line_no in range(first, len(lines)):
+            line_addresses.append(address)
+            for item in results[line_no]:
+                if isinstance(item.value, Label):
+                    if item.value in label_addresses:
+                        raise AssemblyError('Label {} defined more than once'.format(item.value.name))
+                    label_addresses[item.value] = address
+                    label_lines[item.value] = line_no
+                else:
+                    address += ADDRESS_INCREMENT
+        # Lines added at the end start here next time
+        line_addresses.append(address)
+
+        # Encode, reusing every word whose inputs are unchanged
+        machine_code = []
+        encode_cache = {}
+        address = 0
+        for line, items in zip(lines, results):
+            for n, item in enumerate(items):
+                if isinstance(item.value, Label):
+                    continue
+                instruction = item.value[0].value
+                arguments = [it.value for it in item.value[1:]]
+                target = None
+                if arguments and isinstance(arguments[-1], Label):
+                    target = label_addresses.get(arguments[-1])
+                    if target is None:
+                        raise AssemblyError('Label "{}" is never defined'.format(arguments[-1].name))
+                    arguments[-1] = target
+                pc_relative = any(kind == PC_RELATIVE for field_name, kind in instruction.format.operands)
+                key = (line, n, address if pc_relative else None, target)
+                word = self.encode_cache.get(key)
+                if word is None:
+                    word = instruction.to_machine_code(address, *arguments)
+                    self.encoded += 1
+                encode_cache[key] = word
+                machine_code.append(word)
+                address += ADDRESS_INCREMENT
+
+        changed = [index for index, word in enumerate(machine_code)
+                   if index >= len(self.machine_code) or self.machine_code[index] != word]
+
+        self.lines = lines
+        self.line_addresses = line_addresses
+        self.label_lines = label_lines
+        self.label_addresses = label_addresses
+        self.machine_code = machine_code
+        self.encode_cache = encode_cache
+        # Only keep parses of lines that are still in the source
+        if len(self.parse_cache) > 2 * len(lines):
+            self.parse_cache = {line: self.parse_cache[line] for line in lines}
+        return changed
+
+
+# Rewrite only the records of an output file that changed. old_count is the number of records already in outfile
+# (written in the same format), or None to write a new file.
+def write_changes(outfile, old_count, machine_code, changed, out_format, skip_odd):
+    writer = RecordWriter(outfile, out_format, skip_odd, existing=old_count)
+    if old_count is None:
+        old_count = 0
+    for index in changed:
+        if index < old_count:
+            writer[index] = machine_code[index]
+    for word in machine_code[old_count:]:
+        writer.append(word)
+    if len(machine_code) < old_count:
+        writer.truncate(len(machine_code))
+
+
+# Re-assemble infile into outfile whenever it changes, until interrupted
+def watch(infile, outfile, out_format, skip_odd, interval=0.5):
+    assembler = IncrementalAssembler()
+    last_mtime = None
+    written = None  # Number of records in outfile, or None if it needs rewriting from scratch
+    try:
+        while True:
+            mtime = os.stat(infile).st_mtime_ns
+            if mtime != last_mtime:
+                last_mtime = mtime
+                with open(infile, 'r') as source:
+                    text = source.read()
+                start = time.perf_counter()
+                try:
+                    changed = assembler.update(text)
+                except AssemblySyntaxError as e:
+                    e.parse_input.display_error(e.error, 4, 5)
+                    continue
+                except AssemblyError as e:
+                    print('Error: {}'.format(e))
+                    continue
+                with open(outfile, 'wb' if written is None else 'r+b') as output:
+                    write_changes(output, written, assembler.machine_code, changed, out_format, skip_odd)
+                written = len(assembler.machine_code)
+                print('Assembled {}: {} lines parsed, {} instructions encoded, {} words written ({:.1f} ms)'.format(
+                    infile, assembler.parsed, assembler.encoded, len(changed), (time.perf_counter() - start) * 1000))
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
@@ -7,68 +7,155 @@ J_TYPE_IMMEDIATE_BITS = 13
 ADDRESS_INCREMENT = 2
 
 
+# Raised for errors found after parsing, e.g. undefined or duplicate labels or operands that don't fit their field
+class AssemblyError(Exception):
+    pass
+
+
+# A field of an instruction word: width bits starting at bit position (counted from the least significant bit).
+# Signed fields hold two's complement values.
+class Field:
+    def __init__(self, name, width, position, signed=False):
+        self.name = name
+        self.width = width
+        self.position = position
+        self.signed = signed
+        self.mask = (1 << width) - 1
+        self.min = -(1 << (width - 1)) if signed else 0
+        self.max = (1 << (width - 1)) - 1 if signed else (1 << width) - 1
+
+    def __repr__(self):
+        return 'Field({}, {} bits at {})'.format(self.name, self.width, self.position)
+
+
+# How an operand is turned into the value of its field
+REGISTER = 'register'  # The register's address
+IMMEDIATE = 'immediate'  # The number as written
+PC_RELATIVE = 'pc_relative'  # Offset from the next instruction to the target address, in instructions
+ABSOLUTE = 'absolute'  # Target address in instructions (instruction memory is always word aligned)
+
+
+# Layout of an instruction type: the fields making up the word, and the field each operand is stored in, in the order
+# the operands are written in assembly.
+class Format:
+    def __init__(self, name, fields, operands):
+        self.name = name
+        self.fields = {field.name: field for field in fields}
+        self.operands = operands  # [(field name, operand kind)]
+
+    def __repr__(self):
+        return '{}-type'.format(self.name)
+
+
+# Field layout. To target a different architecture, change the fields and formats below.
+OPCODE = Field('opcode', OPCODE_BITS, 16 - OPCODE_BITS)
+RS = Field('rs', REG_BITS, 16 - OPCODE_BITS - REG_BITS)
+RT = Field('rt', REG_BITS, 16 - OPCODE_BITS - 2 * REG_BITS)
+RD = Field('rd', REG_BITS, 16 - OPCODE_BITS - 3 * REG_BITS)
+FUNCT = Field('funct', 16 - OPCODE_BITS - 3 * REG_BITS, 0)
+I_IMMEDIATE = Field('imm', I_TYPE_IMMEDIATE_BITS, 0, signed=True)
+J_IMMEDIATE = Field('imm', J_TYPE_IMMEDIATE_BITS, 0)
+
+R_FORMAT = Format('R', [OPCODE, RS, RT, RD, FUNCT], [('rd', REGISTER), ('rs', REGISTER), ('rt', REGISTER)])
+I_FORMAT = Format('I', [OPCODE, RS, RT, I_IMMEDIATE], [('rt', REGISTER), ('rs', REGISTER), ('imm', IMMEDIATE)])
+BRANCH_FORMAT = Format('Branch', [OPCODE, RS, RT, I_IMMEDIATE],
+                       [('rt', REGISTER), ('rs', REGISTER), ('imm', PC_RELATIVE)])
+J_FORMAT = Format('J', [OPCODE, J_IMMEDIATE], [('imm', ABSOLUTE)])
+NO_OPERAND_FORMAT = Format('No-operand', [OPCODE], [])
+
+
+# Python expression converting operand n to its field value, for each operand kind
+OPERAND_VALUE = {
+    REGISTER: 'a{n}.address',
+    IMMEDIATE: 'a{n}',
+    PC_RELATIVE: '(a{n} - address - ADDRESS_INCREMENT) // ADDRESS_INCREMENT',
+    ABSOLUTE: 'a{n} // ADDRESS_INCREMENT',
+}
+
+
+def operand_out_of_range(instruction, address, field, value):
+    raise AssemblyError('{} at address {}: {} {} is out of range ({} to {})'.format(
+        instruction.name, address, field.name, value, field.min, field.max))
+
+
+# Build the encoding function for an instruction from its format. The base word, shifts, masks and ranges are all
+# constants in the generated code, so encoding is a (range check and) OR per operand. For example, bne becomes:
+#   def to_machine_code(address, a0, a1, a2, *unused):
+#       v0 = a0.address
+#       v1 = a1.address
+#       v2 = (a2 - address - ADDRESS_INCREMENT) // ADDRESS_INCREMENT
+#       if not -64 <= v2 <= 63: operand_out_of_range(instruction, address, fields[2], v2)
+#       return 16384 | (v0 & 7) << 7 | (v1 & 7) << 10 | (v2 & 127) << 0
+def compile_encoder(instruction):
+    fields = [instruction.format.fields[field_name] for field_name, kind in instruction.format.operands]
+    params = ''.join('a{}, '.format(n) for n in range(len(fields)))
+    lines = ['def to_machine_code(address, {}*unused):'.format(params)]
+    word = [str(instruction.base_word)]
+    for n, (field, (field_name, kind)) in enumerate(zip(fields, instruction.format.operands)):
+        lines.append('    v{} = {}'.format(n, OPERAND_VALUE[kind].format(n=n)))
+        if kind != REGISTER:  # Register addresses come from registers.py, so they don't need checking every time
+            lines.append('    if not {} <= v{n} <= {}: operand_out_of_range(instruction, address, fields[{n}], v{n})'
+                         .format(field.min, field.max, n=n))
+        word.append('(v{} & {}) << {}'.format(n, field.mask, field.position))
+    lines.append('    return ' + ' | '.join(word))
+
+    namespace = {'instruction': instruction, 'fields': fields, 'operand_out_of_range': operand_out_of_range,
+                 'ADDRESS_INCREMENT': ADDRESS_INCREMENT}
+    exec('\n'.join(lines), namespace)
+    return namespace['to_machine_code']
+
+
 # Basic instruction, all fields except opcode are zero.
+# Every instruction precomputes its base word (the fields that are the same every time it is used, like the opcode)
+# and compiles a to_machine_code function that ORs its operands into it the first time it is used.
 class Instruction:
+    format = NO_OPERAND_FORMAT
+
     def __init__(self, name, opcode):
         self.name = name
         self.opcode = opcode
+        self.base_word = 0
+        for field_name, value in self.constant_fields().items():
+            field = self.format.fields[field_name]
+            if not field.min <= value <= field.max:
+                raise ValueError('{} of {} does not fit in {} bits'.format(field_name, name, field.width))
+            self.base_word |= (value & field.mask) << field.position
 
     def __repr__(self):
         return self.name
 
+    # Returns the instruction word for the given operands. The first call compiles the encoder and stores it on the
+    # instance, where it replaces this method, so only the instructions a program uses are ever compiled.
     def to_machine_code(self, address, *args):
-        return self.opcode << (16 - OPCODE_BITS)
+        self.to_machine_code = compile_encoder(self)
+        return self.to_machine_code(address, *args)
+
+    # Fields set by the instruction itself rather than by its operands
+    def constant_fields(self):
+        return {'opcode': self.opcode}
 
 
 class RType(Instruction):
+    format = R_FORMAT
+
     def __init__(self, name, opcode, funct):
-        super().__init__(name, opcode)
         self.funct = funct
+        super().__init__(name, opcode)
 
-    def to_machine_code(self, address, *args):
-        rd = args[0]
-        rs = args[1]
-        rt = args[2]
-        assert (self.funct < 32)
-        return (self.opcode << (16 - OPCODE_BITS)) \
-               + (rs.address << (16 - OPCODE_BITS - REG_BITS)) \
-               + (rt.address << (16 - OPCODE_BITS - 2 * REG_BITS)) \
-               + (rd.address << (16 - OPCODE_BITS - 3 * REG_BITS)) \
-               + self.funct
+    def constant_fields(self):
+        return {'opcode': self.opcode, 'funct': self.funct}
 
 
 class IType(Instruction):
-    def to_machine_code(self, address, *args):
-        rt = args[0]
-        rs = args[1]
-        imm = args[2]
-        assert(128 > imm > -129)
-        imm = imm & 0b1111111  # 7 bit immediate
-        return (self.opcode << (16 - OPCODE_BITS)) \
-               + (rs.address << (16 - OPCODE_BITS - REG_BITS)) \
-               + (rt.address << (16 - OPCODE_BITS - 2 * REG_BITS)) \
-               + imm
+    format = I_FORMAT
 
 
 class Branch(IType):
-    def to_machine_code(self, address, *args):
-        rt = args[0]
-        rs = args[1]
-        target_addr = args[2]
-        imm = (target_addr - address - ADDRESS_INCREMENT) // ADDRESS_INCREMENT
-        assert(128 > imm > -129)
-        imm = imm & 0b1111111  # 7 bit immediate
-        return (self.opcode << (16 - OPCODE_BITS)) \
-               + (rs.address << (16 - OPCODE_BITS - REG_BITS)) \
-               + (rt.address << (16 - OPCODE_BITS - 2 * REG_BITS)) \
-               + imm
+    format = BRANCH_FORMAT
 
 
 class JType(Instruction):
-    def to_machine_code(self, address, *args):
-        imm = args[0] // ADDRESS_INCREMENT  # Divide by ADDRESS_INCREMENT because we assume instruction memory is always word aligned
-
-        return (self.opcode << (16 - OPCODE_BITS)) + imm
+    format = J_FORMAT
 
 
 # R-type instruction with three register arguments and a function code
@@ -113,4 +200,7 @@ nop_instructions = [
 all_instructions = r_instructions + reduced_r_instructions + i_instructions + j_instructions + nop_instructions
 
 # Reserved names cannot be labels
-reserved_names = [i.name for i in all_instructions]
\ No newline at end of file
+reserved_names = [i.name for i in all_instructions]
+
+# Mnemonic lookup table used by the parser: case-folded name -> instruction
+mnemonics = {i.name.casefold(): i for i in all_instructions}
\ No newline at end of file
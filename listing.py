@@ -0,0 +1,170 @@
+from instructions import ADDRESS_INCREMENT
+from parser import LineIndex
+
+from array import array
+from bisect import bisect_right
+from itertools import islice
+import operator
+
+# Source map and listing (--map, --listing): which source line every word came from, for finding the line of an
+# address the simulator stopped at.
+#
+# The Assembler records an entry for every instruction and data directive as it encodes it: its address and the
+# offset in the source of the item (ParseResult.loc). Items from a macro or an included file are at the line that
+# expanded or included them. Where a .org or .space moves the address, and at the end of the program, a gap entry
+# (offset NO_SOURCE) marks that the words before it have ended, so every entry's words run up to the address of the
+# entry after it. The entries are recorded in source order, which is the order of the listing. Lookups by address use
+# the same entries sorted by address (they already are unless a .org goes backwards), with a binary search.
+
+NO_SOURCE = -1
+
+
+class SourceMap:
+    def __init__(self, addresses=None, offsets=None, labels=None):
+        self.addresses = addresses if addresses is not None else array('L')  # In the order the items were added
+        self.offsets = offsets if offsets is not None else array('l')
+        self.labels = labels if labels is not None else {}  # {label name: address}
+        self._by_address = None  # (addresses, offsets) sorted by address
+        self._symbols = None  # (addresses, names) of the labels, sorted by address
+        self._lines = None  # LineIndex of the last text lines were looked up in
+
+    # Nothing is at address or after it, until the next entry
+    def gap(self, address):
+        self.addresses.append(address)
+        self.offsets.append(NO_SOURCE)
+
+    def set_labels(self, label_addresses):
+        self.labels = {getattr(label, 'name', label): address for label, address in label_addresses.items()}
+        self._symbols = None
+
+    def by_address(self):
+        if self._by_address is None:
+            addresses = self.addresses
+            if all(map(operator.le, addresses, islice(addresses, 1, None))):
+                self._by_address = (addresses, self.offsets)
+            else:
+                # Gap entries sort before an item at the same address, so a lookup finds the item
+                entries = sorted(zip(addresses, self.offsets))
+                self._by_address = (array('L', (entry[0] for entry in entries)),
+                                    array('l', (entry[1] for entry in entries)))
+        return self._by_address
+
+    # Source offset of the item the word at address came from, or None if no word is there
+    def offset(self, address):
+        addresses, offsets = self.by_address()
+        index = bisect_right(addresses, address) - 1
+        if index < 0 or offsets[index] == NO_SOURCE:
+            return None
+        return offsets[index]
+
+    # Line number (starting at 1) in text of the item the word at address came from, or None. The line starts of text
+    # are found once and kept for later lookups in the same text.
+    def line(self, address, text):
+        offset = self.offset(address)
+        if offset is None:
+            return None
+        if self._lines is None or self._lines.text is not text:
+            self._lines = LineIndex(text)
+        return self._lines.line_number(offset)
+
+    # (name, distance) of the closest label at or before address, or None if there is none
+    def symbol(self, address):
+        if self._symbols is None:
+            symbols = sorted((label_address, name) for name, label_address in self.labels.items())
+            self._symbols = ([symbol[0] for symbol in symbols], [symbol[1] for symbol in symbols])
+        addresses, names = self._symbols
+        index = bisect_right(addresses, address) - 1
+        if index < 0:
+            return None
+        return names[index], address - addresses[index]
+
+    def to_dict(self, source=None):
+        addresses, offsets = self.by_address()
+        return {'source': source, 'addresses': addresses.tolist(), 'offsets': offsets.tolist(), 'labels': self.labels}
+
+    @staticmethod
+    def from_dict(data):
+        return SourceMap(array('L', data['addresses']), array('l', data['offsets']), data['labels'])
+
+    def save(self, path, source=None):
+        import json
+        with open(path, 'w') as map_file:
+            map_file.write(json.dumps(self.to_dict(source), separators=(',', ':')))
+
+    @staticmethod
+    def load(path):
+        import json
+        with open(path, 'r') as map_file:
+            return SourceMap.from_dict(json.load(map_file))
+
+
+WORDS_PER_LINE = 4  # Words of a data directive listed on each line
+
+
+# Write a listing of text: every source line, with the address and words of the items on it, e.g.
+#    12  0016  2c41                 loop: addi $s1, $s1, 1
+# The words are read from image, the MemoryImage the source map was recorded for.
+def write_listing(listing_file, text, source_map, image):
+    lines = text.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    addresses = source_map.addresses
+    offsets = source_map.offsets
+    number_width = len(str(len(lines)))
+    address_width = max(4, len('{:x}'.format(max(addresses, default=0))))
+    code_width = WORDS_PER_LINE * 5 - 1
+    # Line number, address, words and source line
+    code_format = '{:>%d}  {:0%dx}  {:<%d}  {}' % (number_width, address_width, code_width)
+    instruction_format = '{:>%d}  {:0%dx}  {:04x}%s  {}' % (number_width, address_width, ' ' * (code_width - 4))
+    blank_format = '{:>%d}  %s  {}' % (number_width, ' ' * (address_width + 2 + code_width))
+    continuation_format = '%s  {:0%dx}  {}' % (' ' * number_width, address_width)
+
+    # line_starts[n] is the offset of line n + 1, with one past the end so the search below always stops
+    line_starts = [0]
+    for line in lines:
+        line_starts.append(line_starts[-1] + len(line) + 1)
+    line_starts.append(float('inf'))
+
+    out = []
+    listed = 0  # Lines written so far
+    line_no = 1  # Line of the current entry (entries are in source order, so it only moves forward)
+    segment = None
+    segment_start = segment_end = 0
+    for n in range(len(offsets)):
+        offset = offsets[n]
+        if offset == NO_SOURCE:
+            continue
+        while line_starts[line_no] <= offset:
+            line_no += 1
+        address = addresses[n]
+        count = (addresses[n + 1] - address) // ADDRESS_INCREMENT
+        if count and not segment_start <= address < segment_end:
+            segment = image.segment(address)
+            segment_start = segment.address
+            segment_end = segment.end()
+        index = (address - segment_start) // ADDRESS_INCREMENT if count else 0
+
+        source_line = None  # Only the first entry on a line is listed with it
+        if line_no > listed:
+            while listed < line_no - 1:
+                listed += 1
+                out.append(blank_format.format(listed, lines[listed - 1]).rstrip())
+            listed = line_no
+            source_line = lines[line_no - 1]
+        if count == 1 and source_line is not None:
+            out.append(instruction_format.format(line_no, address, segment.words[index], source_line))
+            continue
+        words = segment.words[index:index + count] if count else []
+        for start in range(0, max(count, 1), WORDS_PER_LINE):
+            code = ' '.join('{:04x}'.format(word) for word in words[start:start + WORDS_PER_LINE])
+            if source_line is not None:
+                out.append(code_format.format(line_no, address + start * ADDRESS_INCREMENT, code, source_line))
+                source_line = None
+            else:
+                out.append(continuation_format.format(address + start * ADDRESS_INCREMENT, code))
+    while listed < len(lines):
+        listed += 1
+        out.append(blank_format.format(listed, lines[listed - 1]).rstrip())
+    listing_file.write('\n'.join(out))
+    if out:
+        listing_file.write('\n')
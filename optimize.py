@@ -0,0 +1,89 @@
+from instructions import I_IMMEDIATE, Branch, JType, reduced_r_instructions, r_instructions
+from parser import Label, ParseResult
+from registers import registers
+
+# Peephole optimizer (--optimize): removes instructions that don't do anything and folds additions, before labels are
+# assigned addresses, so label addresses and branch offsets are computed for the smaller program as usual.
+#   - Writes to $zero (which always reads 0), e.g. add $zero, $s0, $s1
+#   - addi $x, $x, 0
+#   - addi $x, $y, a followed by addi $x, $x, b becomes addi $x, $y, a+b if a+b fits the immediate field
+#   - Jumps and branches to the next instruction
+# nop is left alone: it assembles to the same word as halt. Only instructions that nothing can jump between (there is
+# no label between them) are folded. Labels on removed instructions end up on the next instruction, which is where
+# execution continues anyway.
+# Branches and jumps to numeric addresses refer to the layout before anything is removed, so a source with any of them
+# is left as it is.
+
+# Instructions whose first operand is the register they write (and that do nothing else)
+WRITES_FIRST_OPERAND = {instruction.name for instruction in r_instructions + reduced_r_instructions} | {'addi', 'lw'}
+
+zero = registers[0]
+
+
+def is_addi(value):
+    return value[0].value.name == 'addi' and isinstance(value[3].value, int)
+
+
+def has_numeric_target(value):
+    return isinstance(value[0].value, (Branch, JType)) and not isinstance(value[-1].value, Label)
+
+
+# Returns the optimized items and {optimization: number of instructions removed}
+def optimize_items(items):
+    removed = {'dead_writes': 0, 'folded_addi': 0, 'jumps_to_next': 0}
+    if any(hasattr(item.value, '__iter__') and has_numeric_target(item.value) for item in items):
+        return items, removed
+    # Removing an instruction can make another one removable (e.g. a jump over it), so passes are repeated until
+    # nothing changes
+    while True:
+        before = sum(removed.values())
+        items = optimize_pass(items, removed)
+        if sum(removed.values()) == before:
+            return items, removed
+
+
+def optimize_pass(items, removed):
+    optimized = []
+    for index, item in enumerate(items):
+        value = item.value
+        if not hasattr(value, '__iter__'):
+            optimized.append(item)
+            continue
+        instruction = value[0].value
+        name = instruction.name
+
+        if name in WRITES_FIRST_OPERAND and value[1].value is zero:
+            removed['dead_writes'] += 1
+            continue
+
+        if name == 'addi' and is_addi(value) and value[1].value is value[2].value:
+            if value[3].value == 0:
+                removed['folded_addi'] += 1
+                continue
+            previous = optimized[-1].value if optimized else None
+            if hasattr(previous, '__iter__') and is_addi(previous) and previous[1].value is value[1].value:
+                total = previous[3].value + value[3].value
+                if I_IMMEDIATE.min <= total <= I_IMMEDIATE.max:
+                    removed['folded_addi'] += 1
+                    if total == 0 and previous[2].value is previous[1].value:
+                        optimized.pop()
+                        removed['folded_addi'] += 1
+                    else:
+                        folded = previous[:3] + [ParseResult(value[3].loc, total)]
+                        optimized[-1] = ParseResult(optimized[-1].loc, folded)
+                    continue
+
+        if isinstance(instruction, (Branch, JType)) and isinstance(value[-1].value, Label):
+            # The target is the next instruction if it is one of the labels right after this one
+            target = value[-1].value
+            following = index + 1
+            while following < len(items) and isinstance(items[following].value, Label):
+                if items[following].value is target:
+                    break
+                following += 1
+            if following < len(items) and items[following].value is target:
+                removed['jumps_to_next'] += 1
+                continue
+
+        optimized.append(item)
+    return optimized
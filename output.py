@@ -0,0 +1,296 @@
+from image import MemoryImage
+from instructions import ADDRESS_INCREMENT, AssemblyError
+
+from array import array
+import mmap
+import os
+import sys
+
+# Formats with one fixed-size text record per instruction, which can be written as the program is assembled
+RECORD_FORMATS = ['words', 'bytes', 'binary']
+
+# Byte order of the raw formats. The text bytes format and Intel HEX use big-endian.
+BYTE_ORDERS = {'raw_be': 'big', 'raw_le': 'little', 'ihex': 'big'}
+
+# Header required for Digital to recognize hex file
+HEADERS = {
+    'bytes': 'v2.0 raw\n',
+    'words': 'v2.0 raw\n',
+    'binary': '',
+}
+
+
+# Text written to the output file for one instruction
+def format_word(instruction, out_format, skip_odd):
+    if out_format == 'bytes':
+        word = '{:04x}'.format(instruction)
+        # Handle skip odd addresses argument
+        if skip_odd:
+            # Write individual bytes on separate lines with zero bytes in between
+            return '{}\n00\n{}\n00\n'.format(word[0:2], word[2:4])
+        else:
+            # Write individual bytes on separate lines
+            return '{}\n{}\n'.format(word[0:2], word[2:4])
+    elif out_format == 'words':
+        word = '{:04x}'.format(instruction)
+        # Handle skip odd addresses argument
+        if skip_odd:
+            # Write each 2-byte word on its own line with zeros in between
+            return '{}\n0000\n'.format(word)
+        else:
+            # Write each 2-byte word on its own line
+            return '{}\n'.format(word)
+    elif out_format == 'binary':
+        # Write each 2-byte word on its own line in binary
+        word = '{:016b}\n'.format(instruction)
+        if skip_odd:
+            # write a line of zeros on odd addresses
+            word += '{:016b}\n'.format(0)
+        return word
+
+
+# Lookup tables for the text formats. Rendering a word is a table lookup instead of a format call and string slicing.
+# The 65536-entry tables map a whole word to its text and are built from the 256-entry byte tables the first time a
+# big program is written in that format. Building one takes a few milliseconds, so smaller programs look up each byte
+# in the 256-entry tables instead.
+HEX_BYTES = ['{:02x}'.format(byte) for byte in range(256)]
+BINARY_BYTES = ['{:08b}'.format(byte) for byte in range(256)]
+
+WORD_TABLE_MIN_WORDS = 8192
+
+word_tables = {}  # (format, skip_odd) -> 65536-entry table
+
+
+# Text after each byte (bytes format) or word (words and binary formats)
+def text_separator(out_format, skip_odd):
+    if not skip_odd:
+        return '\n'
+    elif out_format == 'bytes':
+        return '\n00\n'
+    elif out_format == 'words':
+        return '\n0000\n'
+    else:
+        return '\n{:016b}\n'.format(0)
+
+
+def word_table(out_format, skip_odd):
+    table = word_tables.get((out_format, skip_odd))
+    if table is None:
+        sep = text_separator(out_format, skip_odd)
+        if out_format == 'bytes':
+            table = [hi + sep + lo + sep for hi in HEX_BYTES for lo in HEX_BYTES]
+        else:
+            byte_text = BINARY_BYTES if out_format == 'binary' else HEX_BYTES
+            table = [hi + lo + sep for hi in byte_text for lo in byte_text]
+        word_tables[(out_format, skip_odd)] = table
+    return table
+
+
+# Text of a run of words in the bytes, words and binary formats, the same as writing format_word for every word
+def render_words(words, out_format, skip_odd):
+    if len(words) >= WORD_TABLE_MIN_WORDS:
+        table = word_table(out_format, skip_odd)
+        return ''.join(map(table.__getitem__, words))
+    sep = text_separator(out_format, skip_odd)
+    byte_text = BINARY_BYTES if out_format == 'binary' else HEX_BYTES
+    if out_format == 'bytes':
+        return ''.join([byte_text[word >> 8] + sep + byte_text[word & 0xFF] + sep for word in words])
+    return ''.join([byte_text[word >> 8] + byte_text[word & 0xFF] + sep for word in words])
+
+
+# Whole output file for the bytes, words and binary formats. These list every address from 0, so the gaps in the
+# image are written as zero words, repeating the text of one zero word instead of rendering each of them.
+def render_text(image, out_format, skip_odd):
+    parts = [HEADERS[out_format]]
+    zero = format_word(0, out_format, skip_odd)
+    for gap, segment in image.runs():
+        parts.append(zero * gap)
+        parts.append(render_words(segment.words, out_format, skip_odd))
+    return ''.join(parts)
+
+
+# Bytes of a run of words, each word in the given byte order ('big' or 'little').
+# With skip_odd, every byte is followed by a zero byte, like the bytes format.
+def word_bytes(words, byteorder, skip_odd):
+    if byteorder != sys.byteorder:
+        words = array('H', words)
+        words.byteswap()
+    data = words.tobytes()
+    if skip_odd:
+        padded = bytearray(2 * len(data))
+        padded[0::2] = data
+        data = bytes(padded)
+    return data
+
+
+# Memory image as bytes from address 0 to the end of the last segment, with zero bytes in the gaps
+def byte_image(image, byteorder, skip_odd):
+    scale = 2 if skip_odd else 1
+    return b''.join(bytes(gap * ADDRESS_INCREMENT * scale) + word_bytes(segment.words, byteorder, skip_odd)
+                    for gap, segment in image.runs())
+
+
+# Intel HEX records for blocks of bytes: [(address, data)], in order. Records hold up to 16 bytes and never cross a 64K
+# boundary; an extended linear address record sets the upper 16 bits of the address when it changes. Nothing is
+# written for the addresses between blocks.
+def ihex_text(blocks):
+    lines = []
+    upper = 0
+    for block_address, block in blocks:
+        for offset in range(0, len(block), 16):
+            address = block_address + offset
+            data = block[offset:offset + 16]
+            if address >> 16 != upper:
+                upper = address >> 16
+                lines.append(ihex_record(0, 0x04, upper.to_bytes(2, 'big')))
+            # Split the record if it would cross into the next 64K block
+            split = min(len(data), 0x10000 - (address & 0xFFFF))
+            lines.append(ihex_record(address & 0xFFFF, 0x00, data[:split]))
+            if split < len(data):
+                upper = (address + split) >> 16
+                lines.append(ihex_record(0, 0x04, upper.to_bytes(2, 'big')))
+                lines.append(ihex_record(0, 0x00, data[split:]))
+    lines.append(ihex_record(0, 0x01, b''))  # End of file
+    return ''.join(lines)
+
+
+def ihex_record(address, record_type, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, record_type]) + data
+    return ':{}{:02X}\n'.format(record.hex().upper(), -sum(record) & 0xFF)
+
+
+# Intel HEX of the image loaded at address base, one block per segment
+def render_ihex(image, skip_odd, base=0):
+    scale = 2 if skip_odd else 1
+    return ihex_text([(base + segment.address * scale, word_bytes(segment.words, BYTE_ORDERS['ihex'], skip_odd))
+                      for segment in image.segments])
+
+
+# Verilog $readmemh text: one word per line, starting at word address base // 2. Every segment after a gap starts with
+# an @address line.
+# With skip_odd, every word is followed by a zero word, like the words format.
+def memh_text(image, skip_odd, base=0):
+    if base % 2:
+        raise AssemblyError('memh output must start at an even address, not {}'.format(base))
+    scale = 2 if skip_odd else 1
+    parts = []
+    address = 0
+    for segment in image.segments:
+        words = segment.words
+        if skip_odd:
+            padded = array('H', bytes(4 * len(words)))
+            padded[0::2] = words
+            words = padded
+        if segment.address != address or (base and not parts):
+            parts.append('@{:x}\n'.format((base + segment.address * scale) // 2))
+        parts.append(''.join(['{:04x}\n'.format(word) for word in words]))
+        address = segment.end()
+    return ''.join(parts)
+
+
+# Output formats. Each renders the whole output file at once, so it is written with a single write:
+# render(image, skip_odd, base) returns the file contents of a MemoryImage, as bytes for binary formats and as a str
+# otherwise. base is the address of the first byte, for formats that record addresses.
+# Formats without addresses (text and raw) hold every word from address 0, with zeros in the gaps of the image.
+class OutputFormat:
+    def __init__(self, name, render, suffix, binary=False):
+        self.name = name
+        self.render = render
+        self.suffix = suffix  # Default output file extension
+        self.binary = binary
+
+    def __repr__(self):
+        return self.name
+
+
+FORMATS = {}
+OUTPUT_FORMATS = []
+
+
+# Add an output format, available from the command line as -f name
+def register_format(name, render, suffix, binary=False):
+    FORMATS[name] = OutputFormat(name, render, suffix, binary)
+    OUTPUT_FORMATS.append(name)
+
+
+register_format('words', lambda image, skip_odd, base: render_text(image, 'words', skip_odd), '.hex')
+register_format('bytes', lambda image, skip_odd, base: render_text(image, 'bytes', skip_odd), '.hex')
+register_format('binary', lambda image, skip_odd, base: render_text(image, 'binary', skip_odd), '.txt')
+register_format('raw_be', lambda image, skip_odd, base: byte_image(image, 'big', skip_odd), '.bin', binary=True)
+register_format('raw_le', lambda image, skip_odd, base: byte_image(image, 'little', skip_odd), '.bin', binary=True)
+register_format('ihex', render_ihex, '.ihex')
+register_format('memh', memh_text, '.mem')
+
+
+# Write a MemoryImage, or a list of words starting at address 0.
+# outfile must be opened in binary mode for binary formats and in text mode otherwise
+def write_machine_code(outfile, image, out_format, skip_odd, base=0):
+    if not isinstance(image, MemoryImage):
+        image = MemoryImage.from_words(image)
+    outfile.write(FORMATS[out_format].render(image, skip_odd, base))
+
+
+# Copy the program into an existing ROM image file at byte offset base, through a memory map so the rest of the file
+# is neither read nor rewritten. Only the segments of the image are copied, gaps keep the contents of the file.
+# The file must already be big enough.
+def write_rom_image(path, image, out_format, skip_odd, base=0):
+    if not isinstance(image, MemoryImage):
+        image = MemoryImage.from_words(image)
+    scale = 2 if skip_odd else 1
+    blocks = [(base + segment.address * scale, word_bytes(segment.words, BYTE_ORDERS[out_format], skip_odd))
+              for segment in image.segments]
+    with open(path, 'r+b') as rom:
+        size = os.fstat(rom.fileno()).st_size
+        end = blocks[-1][0] + len(blocks[-1][1]) if blocks else base
+        if base < 0 or end > size:
+            raise AssemblyError('Program ({} bytes at offset {}) does not fit in ROM image {} ({} bytes)'.format(
+                end - base, base, path, size))
+        if not blocks:
+            return
+        with mmap.mmap(rom.fileno(), 0) as rom_map:
+            for offset, data in blocks:
+                rom_map[offset:offset + len(data)] = data
+            rom_map.flush()
+
+
+# Writes each instruction as a fixed-size record in a seekable binary file, so an instruction that was written early
+# (e.g. with a placeholder for a forward reference) can be overwritten in place later.
+# Supports the same append()/item assignment interface as a list so it can be used as an Assembler's machine_code.
+# If existing is given, outfile already holds that many records in this format and they are updated in place.
+class RecordWriter:
+    def __init__(self, outfile, out_format, skip_odd, existing=None):
+        self.outfile = outfile
+        self.out_format = out_format
+        self.skip_odd = skip_odd
+        self.header_size = len(HEADERS[out_format])
+        self.record_size = len(format_word(0, out_format, skip_odd))
+        if existing is None:
+            self.count = 0
+            outfile.write(HEADERS[out_format].encode('ascii'))
+        else:
+            self.count = existing
+            outfile.seek(self.header_size + existing * self.record_size)
+
+    def record(self, instruction):
+        if not 0 <= instruction <= 0xFFFF:
+            raise AssemblyError('Instruction word {} does not fit in 16 bits'.format(instruction))
+        return format_word(instruction, self.out_format, self.skip_odd).encode('ascii')
+
+    def append(self, instruction):
+        self.outfile.write(self.record(instruction))
+        self.count += 1
+
+    def __setitem__(self, index, instruction):
+        end = self.outfile.tell()
+        self.outfile.seek(self.header_size + index * self.record_size)
+        self.outfile.write(self.record(instruction))
+        self.outfile.seek(end)
+
+    def __len__(self):
+        return self.count
+
+    # Drop every record after the first count
+    def truncate(self, count):
+        self.outfile.seek(self.header_size + count * self.record_size)
+        self.outfile.truncate()
+        self.count = count
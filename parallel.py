@@ -0,0 +1,138 @@
+from encoder import Assembler, AssemblySyntaxError
+from instructions import ADDRESS_INCREMENT, AssemblyError, PC_RELATIVE, mnemonics
+from parser import parse_asm, parse_asm_fast, Label, ParserInput
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+# Parallel assembly of a single large source. The text is split into chunks at line boundaries and each chunk is parsed
+# and encoded in a worker process. The chunks are merged in order: each chunk's label addresses are offset by the
+# number of instructions before it (a prefix sum), and instructions that depend on their absolute address or on a label
+# are encoded once the global label table is built.
+#
+# Only the error-free case runs in parallel. If a chunk has an error, the source is assembled serially from the start
+# of that chunk (parse errors) or from the beginning (label and range errors), so errors are reported in the original
+# file's coordinates exactly as the serial assembler reports them. Like --stream, this assumes no instruction is split
+# across lines; if one is, the chunk before it fails to parse and the serial parser takes over.
+
+MIN_CHUNK_SIZE = 256 * 1024  # Characters. Smaller chunks cost more to send to a worker than to parse.
+
+# Instructions whose encoding depends on their own address
+ADDRESS_DEPENDENT = {instruction for instruction in mnemonics.values()
+                     if any(kind == PC_RELATIVE for field_name, kind in instruction.format.operands)}
+
+
+# Split text at line boundaries into at most count chunks of at least MIN_CHUNK_SIZE characters.
+# Returns the start offset of every chunk.
+def chunk_starts(text, count):
+    size = max(MIN_CHUNK_SIZE, len(text) // max(count, 1) + 1)
+    starts = [0]
+    while True:
+        end = text.find('\n', starts[-1] + size)
+        if end == -1 or end + 1 >= len(text):
+            return starts
+        starts.append(end + 1)
+
+
+# Worker: parse and encode one chunk as if it started at address 0.
+# Returns None if the chunk has a syntax error, False if it has an encoding error, otherwise (words, labels, fixups):
+#   words: array of instruction words, with 0 for instructions in fixups
+#   labels: [(label name, address within the chunk)]
+#   fixups: [(index, address within the chunk, instruction name, arguments)] for the instructions that depend on their
+#           address or on a label
+def assemble_chunk(chunk):
+    ast, rem = parse_asm_fast(ParserInput(chunk, lazy_errors=True))
+    if ast.error():
+        return None
+    words = array('H')
+    labels = []
+    fixups = []
+    address = 0
+    try:
+        for item in ast.value:
+            value = item.value
+            if isinstance(value, Label):
+                labels.append((value.name, address))
+            elif hasattr(value, '__iter__'):
+                instruction = value[0].value
+                arguments = [it.value for it in value[1:]]
+                if instruction in ADDRESS_DEPENDENT or (arguments and isinstance(arguments[-1], Label)):
+                    fixups.append((len(words), address, instruction.name, arguments))
+                    words.append(0)
+                else:
+                    words.append(instruction.to_machine_code(address, *arguments))
+                address += ADDRESS_INCREMENT
+    except AssemblyError:
+        return False
+    return words, labels, fixups
+
+
+# Merge the chunk results in order. Returns (machine code, {label name: address}), or None if there was a label or
+# encoding error.
+def merge_chunks(results):
+    words = array('H')
+    label_addresses = {}
+    fixups = []
+    for chunk_words, labels, chunk_fixups in results:
+        base_address = len(words) * ADDRESS_INCREMENT
+        for name, address in labels:
+            if name in label_addresses:
+                return None
+            label_addresses[name] = base_address + address
+        for index, address, name, arguments in chunk_fixups:
+            fixups.append((index + len(words), address + base_address, name, arguments))
+        words.extend(chunk_words)
+
+    try:
+        for index, address, name, arguments in fixups:
+            if arguments and isinstance(arguments[-1], Label):
+                target = label_addresses.get(arguments[-1].name)
+                if target is None:
+                    return None
+                arguments[-1] = target
+            words[index] = mnemonics[name].to_machine_code(address, *arguments)
+    except AssemblyError:
+        return None
+    return words.tolist(), label_addresses
+
+
+# Assemble text in this process
+def assemble_serial(text, fast, all_errors):
+    parse_input = ParserInput(text, lazy_errors=True, errors=[] if all_errors else None)
+    ast, rem = parse_asm_fast(parse_input) if fast else parse_asm(parse_input)
+    if ast.error():
+        raise AssemblySyntaxError(parse_input, ast)
+    assembler = Assembler()
+    assembler.add_all(ast.value)
+    machine_code = assembler.finish()
+    return machine_code, {label.name: address for label, address in assembler.label_addresses.items()}
+
+
+# Assemble text using up to workers processes. Returns the same machine code and label addresses as assembling
+# serially, and raises the same AssemblySyntaxError or AssemblyError.
+def assemble_parallel(text, workers=None, fast=True, all_errors=False):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    starts = chunk_starts(text, workers)
+    if workers <= 1 or len(starts) == 1:
+        return assemble_serial(text, fast, all_errors)
+
+    chunks = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        results = list(executor.map(assemble_chunk, chunks))
+
+    for start, result in zip(starts, results):
+        if result is None:
+            # Syntax error. Every chunk before this one parsed, so the error can be found by parsing from its start.
+            # If that succeeds, the chunk boundary split an instruction and the whole source is assembled below.
+            parse_input = ParserInput(text, start, lazy_errors=True, errors=[] if all_errors else None)
+            ast, rem = parse_asm_fast(parse_input) if fast else parse_asm(parse_input)
+            if ast.error():
+                raise AssemblySyntaxError(parse_input, ast)
+            break
+    merged = None if None in results or False in results else merge_chunks(results)
+    if merged is None:
+        # Label or encoding error, assemble everything serially to report it in the same order
+        return assemble_serial(text, fast, all_errors)
+    return merged
@@ -1,10 +1,16 @@
 from instructions import r_instructions, reduced_r_instructions, i_instructions, j_instructions, nop_instructions, \
-    reserved_names
+    reserved_names, mnemonics, RType, IType, JType
 from registers import registers
+from bisect import bisect_right
 import re
+import weakref
 
 
+# Parse tree nodes use __slots__: a big source produces several of them per line, and a per-instance __dict__ would
+# be most of their size.
 class ParseResult:
+    __slots__ = ('loc', 'value')
+
     def __init__(self, loc, value):
         self.loc = loc
         self.value = value
@@ -20,8 +26,12 @@ class ParseResult:
 
 
 class ParseError(ParseResult):
+    __slots__ = ('error_msg', 'causes')
+
     def __init__(self, loc, error_msg, causes=None):
         super(ParseError, self).__init__(loc, None)
+        if counters is not None:
+            counters.errors += 1
         if causes is None:
             causes = []
         self.error_msg = error_msg
@@ -38,26 +48,130 @@ class ParseError(ParseResult):
         return '{}: Error: {}. Causes: {}'.format(self.loc, self.error_msg, self.causes)
 
 
+# Parser statistics, collected between start_counting() and stop_counting(). counters is None the rest of the time, so
+# the parsers only pay for a global lookup.
+class ParserCounters:
+    __slots__ = ('calls', 'backtracks', 'errors', 'fast_items', 'fallback_items')
+
+    def __init__(self):
+        self.calls = 0  # Parser invocations
+        self.backtracks = 0  # Alternatives of parse_any that failed
+        self.errors = 0  # ParseError objects created
+        self.fast_items = 0  # Items decoded by the fast path
+        self.fallback_items = 0  # Items the fast path handed to the combinator parser
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+counters = None
+
+
+def start_counting():
+    global counters
+    counters = ParserCounters()
+
+
+# Stop collecting statistics and return them as a dict
+def stop_counting():
+    global counters
+    result = counters.as_dict()
+    counters = None
+    return result
+
+
+# Returned by every failing parser when errors are lazy. It is never displayed: parse_all re-parses the failing item
+# with detailed errors first.
+lazy_error = ParseError(-1, 'lazy error')
+
+
+# Offsets of the start of every line in a text, so a location can be converted to a line number with a binary search.
+# The index is only built the first time it is needed (usually when reporting an error).
+class LineIndex:
+    # first_line is the line number of the first line of text, for inputs that start part way through a file
+    def __init__(self, text, first_line=1):
+        self.text = text
+        self.first_line = first_line
+        self._line_starts = None
+
+    def line_starts(self):
+        if self._line_starts is None:
+            starts = [0]
+            find = self.text.find
+            idx = find('\n')
+            while idx != -1:
+                starts.append(idx + 1)
+                idx = find('\n', idx + 1)
+            self._line_starts = starts
+        return self._line_starts
+
+    # Line number of the line containing loc
+    def line_number(self, loc):
+        return bisect_right(self.line_starts(), loc) + self.first_line - 1
+
+    # Start and end offsets of a line, not including its newline
+    def line_span(self, line_no):
+        starts = self.line_starts()
+        idx = line_no - self.first_line
+        end = starts[idx + 1] - 1 if idx + 1 < len(starts) else len(self.text)
+        return starts[idx], end
+
+    # Line number and column (starting at 1) of loc
+    def line_col(self, loc):
+        line_no = self.line_number(loc)
+        return line_no, loc - self.line_span(line_no)[0] + 1
+
+    # Offset of the start of the line after the one containing loc (or the end of the text if it is the last line)
+    def next_line_start(self, loc):
+        starts = self.line_starts()
+        idx = bisect_right(starts, loc)
+        return starts[idx] if idx < len(starts) else len(self.text)
+
+
 class ParserInput:
-    def __init__(self, text, loc=0):
+    __slots__ = ('text', 'loc', 'lazy_errors', 'errors', 'lines')
+
+    def __init__(self, text, loc=0, lazy_errors=False, errors=None, lines=None):
         self.text = text  # The actual text to parse
         self.loc = loc  # Stores where in the text parsing is occuring
+        # If set, failed parsers return the shared lazy_error instead of building a ParseError tree. The detailed
+        # error is only rebuilt (by re-parsing the failing item) when the whole parse fails.
+        self.lazy_errors = lazy_errors
+        # If a list is given, parse_all doesn't stop at the first error. Every error is added to this list and parsing
+        # resumes at the next line.
+        self.errors = errors
+        self.lines = lines if lines is not None else LineIndex(text)  # Shared by every input advanced from this one
 
     def advance(self, n):
-        return ParserInput(self.text, self.loc + n)
+        return ParserInput(self.text, self.loc + n, self.lazy_errors, self.errors, self.lines)
+
+    # The same location, but building detailed errors
+    def eager(self):
+        return ParserInput(self.text, self.loc, lines=self.lines)
+
+    # Error for a parser that failed at this location
+    def error(self, error_msg, causes=None):
+        if self.lazy_errors:
+            return lazy_error
+        return ParseError(self.loc, error_msg, causes=causes)
 
-    # Remaining text
+    # True once every character of the input has been consumed
+    def at_end(self):
+        return self.loc >= len(self.text)
+
+    # Remaining text. This copies the rest of the input, so parsers should match against self.text at self.loc
+    # instead of calling this.
     def rtext(self):
         if self.loc >= len(self.text):
             return ''
         else:
             return self.text[self.loc:]
 
+    # Returns the text of the line containing loc, the offset just before the line starts and the line number
     def get_line(self, loc):
-        idx = max(0, self.text.rfind('\n', 0, loc))  # Start of line or start of string
-        line = re.match('.*$', self.text[idx + 1:], flags=re.MULTILINE).group(0)  # Text up to end of line/string
-        line_no = self.text[:idx].count('\n') + 2
-        return line, idx, line_no
+        line_no = self.lines.line_number(loc)
+        start, end = self.lines.line_span(line_no)
+        return self.text[start:end], start - 1, line_no
 
     def display_error(self, error: ParseError, max_depth, max_breadth, indent=0, parent_index=-1):
         if max_depth <= 0:
@@ -83,6 +197,12 @@ class ParserInput:
             for cause in error.causes:
                 self.display_error(cause, max_depth - 1, max_breadth, indent=indent+4, parent_index=error.loc)
 
+    # Display every error collected by parse_all
+    def display_errors(self, max_depth, max_breadth):
+        for error in self.errors:
+            self.display_error(error, max_depth, max_breadth)
+        print('{} error{} found'.format(len(self.errors), '' if len(self.errors) == 1 else 's'))
+
 
 
 
@@ -92,29 +212,58 @@ class ParserInput:
 
 # Element that returns its name when converted to a string, used for debugging
 class Element:
+    __slots__ = ()
+
     def __repr__(self):
         return self.__class__.__name__
 
 
 class Whitespace(Element):
-    pass
+    __slots__ = ()
+
+
+# Whitespace holds no data, so every whitespace run shares one object
+whitespace = Whitespace()
 
 
+# Labels are interned: Label(name) always returns the same object for the same name, so labels compare and hash by
+# identity (a C-level check) instead of calling __eq__/__hash__ on every label_addresses lookup.
+# The table only holds weak references, so labels go away with the last items and label tables using them (--watch
+# and library users assemble many sources in one process, and every macro expansion and relaxed branch adds labels).
 class Label:
-    def __init__(self, name):
-        self.name = name
+    __slots__ = ('name', '__weakref__')
+    interned = weakref.WeakValueDictionary()  # Name -> Label
+
+    def __new__(cls, name):
+        label = cls.interned.get(name)
+        if label is None:
+            label = super().__new__(cls)
+            label.name = name
+            cls.interned[name] = label
+        return label
+
+    # Unpickled labels (e.g. from worker processes) are interned too
+    def __reduce__(self):
+        return Label, (self.name,)
 
     def __repr__(self):
         return 'Label({})'.format(self.name)
 
-    def __eq__(self, other):
-        return self.name == other.name
 
-    def __hash__(self):
-        return self.name.__hash__()
+# Reference to a parameter (\name) in the body of a macro, replaced by the argument when the macro is expanded
+class Parameter:
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Parameter({})'.format(self.name)
 
 
 class Comment:
+    __slots__ = ('text',)
+
     def __init__(self, text):
         self.text = text
 
@@ -122,78 +271,126 @@ class Comment:
         return 'Comment({})'.format(self.text)
 
 
-# Find an object in a list by its 'name' attribute
-def get_obj_by_name(lst, name):
-    return list(filter(lambda it: it.name == name, lst))[0]
+# Patterns are compiled once and matched in place with pattern.match(text, loc), so no parser copies the remaining input
+whitespace_pattern = re.compile(r'\s+')
+comment_pattern = re.compile('[#;].*$', flags=re.MULTILINE)
+label_pattern = re.compile('[a-zA-Z_][a-zA-Z0-9_]*')
+numeric_literal_pattern = re.compile('-?[0-9A-Fxb]+')
+keyword_pattern = re.compile(r'\$?[a-zA-Z0-9_]+')  # Mnemonic or register name
+parameter_pattern = re.compile(r'\\([a-zA-Z_][a-zA-Z0-9_]*)')
+
+
+# Map case-folded names to their objects so a keyword is found with a single dict lookup
+def keyword_table(objs):
+    return {obj.name.casefold(): obj for obj in objs}
+
+
+instruction_table = mnemonics
+register_table = keyword_table(registers)
 
 
 # Parse any amount of whitespace and return a Whitespace object
 def parse_whitespace(i: ParserInput) -> (ParseResult, ParserInput):
-    text = i.rtext()
-    stripped = text.lstrip()
-    if len(stripped) == len(text):
-        return ParseError(i.loc, 'whitespace'), i
+    if counters is not None:
+        counters.calls += 1
+    whitespace_characters = whitespace_pattern.match(i.text, i.loc)
+    if whitespace_characters is None:
+        return i.error('whitespace'), i
     else:
-        return ParseResult(i.loc, Whitespace()), i.advance(len(text) - len(stripped))
+        return ParseResult(i.loc, whitespace), i.advance(whitespace_characters.end() - i.loc)
 
 
 # Parse a single-line comment (Starts with ; or #, ends at end of line)
 def parse_comment(i: ParserInput) -> (ParseResult, ParserInput):
-    comment_characters = re.match('[#;].*$', i.rtext(), flags=re.MULTILINE)
+    if counters is not None:
+        counters.calls += 1
+    comment_characters = comment_pattern.match(i.text, i.loc)
     if comment_characters is None:
-        return ParseError(i.loc, 'comment'), i
+        return i.error('comment'), i
     else:
         match_text = comment_characters.group(0)
         return ParseResult(i.loc, Comment(match_text)), i.advance(len(match_text))
 
 
 def parse_label(i: ParserInput) -> (ParseResult, ParserInput):
-    label_characters = re.match('[a-zA-Z_][a-zA-Z0-9_]*', i.rtext())
+    if counters is not None:
+        counters.calls += 1
+    label_characters = label_pattern.match(i.text, i.loc)
     if label_characters is None:
-        return ParseError(i.loc, 'label'), i
+        return i.error('label'), i
     else:
         match_text = label_characters.group(0)
         if match_text in reserved_names:
-            return ParseError(i.loc, 'label'), i
+            return i.error('label'), i
         return ParseResult(i.loc, Label(match_text)), i.advance(len(match_text))
 
 
+# Parse a macro parameter reference (only allowed in macro bodies)
+def parse_parameter(i: ParserInput) -> (ParseResult, ParserInput):
+    if counters is not None:
+        counters.calls += 1
+    parameter = parameter_pattern.match(i.text, i.loc)
+    if parameter is None:
+        return i.error('macro parameter'), i
+    return ParseResult(i.loc, Parameter(parameter.group(1))), i.advance(parameter.end() - i.loc)
+
+
 # Returns an exact match for the string
 def parse_string(s, case_sensitive=False):
+    folded = s.lower()
+    error_msg = 'string "{}"'.format(s)
+
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
-        text = i.rtext()
+        if counters is not None:
+            counters.calls += 1
         if case_sensitive:
-            if text.startswith(s):
+            if i.text.startswith(s, i.loc):
                 return ParseResult(i.loc, s), i.advance(len(s))
         else:
-            if text.lower().startswith(s.lower()):
+            # Only lowercase the characters that could match, not the rest of the file
+            if i.text[i.loc:i.loc + len(s)].lower() == folded:
                 return ParseResult(i.loc, s), i.advance(len(s))
-        return ParseError(i.loc, 'string "{}"'.format(s)), i
+        return i.error(error_msg), i
 
     return parse_fn
 
 
 def parser_numeric_literal(i: ParserInput) -> (ParseResult, ParserInput):
-    literal_character = re.match('-?[0-9A-Fxb]+', i.rtext())
+    if counters is not None:
+        counters.calls += 1
+    literal_character = numeric_literal_pattern.match(i.text, i.loc)
     if literal_character is None:
-        return ParseError(i.loc, 'numeric literal'), i
+        return i.error('numeric literal'), i
     else:
         try:
             match_text = literal_character.group(0)
             return ParseResult(i.loc, int(match_text, 0)), i.advance(len(match_text))
         except ValueError:
-            return ParseError(i.loc, 'valid numeric literal'), i
+            return i.error('valid numeric literal'), i
 
 
 # Returns the result of the first parser that succeeds
 def parse_any(*parsers, error_msg):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
+        if i.lazy_errors:
+            for parser in parsers:
+                output, rem = parser(i)
+                if not output.error():
+                    return output, rem
+                if counters is not None:
+                    counters.backtracks += 1
+            return lazy_error, i
+
         failure_causes = []
         for parser in parsers:
             output, rem = parser(i)
             if not output.error():
                 return output, rem
             else:
+                if counters is not None:
+                    counters.backtracks += 1
                 failure_causes.append(output)
 
         return ParseError(i.loc, error_msg, causes=failure_causes), i
@@ -204,6 +401,8 @@ def parse_any(*parsers, error_msg):
 # Runs a parser zero or more times and returns a list of the output. Cannot fail.
 def zero_or_more_of(parser):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         loc = i.loc
         output = []
         while True:
@@ -220,6 +419,8 @@ def zero_or_more_of(parser):
 # Same as above, but fails if none are found
 def one_or_more_of(parser):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         loc = i.loc
         output = []
 
@@ -240,17 +441,32 @@ def one_or_more_of(parser):
 
 
 # Runs a parser for all of the output. Fails on any error.
+# If the input collects errors, each error is recorded and parsing continues at the start of the next line. The first
+# error is returned once all of the input has been parsed.
 def parse_all(parser):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         loc = i.loc
         output = []
-        while i.rtext() != '':
+        first_error = None
+        while not i.at_end():
             parse_output, rem = parser(i)
             if parse_output.error():
-                return parse_output, i
+                if i.lazy_errors:
+                    # Rebuild the detailed error by re-parsing the item that failed
+                    parse_output, rem = parser(i.eager())
+                if i.errors is None:
+                    return parse_output, i
+                i.errors.append(parse_output)
+                if first_error is None:
+                    first_error = parse_output
+                i = i.advance(i.lines.next_line_start(parse_output.loc) - i.loc)
             else:
                 output.append(parse_output)
                 i = rem
+        if first_error is not None:
+            return first_error, i
         return ParseResult(loc, output), i
 
     return parse_fn
@@ -259,6 +475,8 @@ def parse_all(parser):
 # Always succeeds, returns empty output if parser fails.
 def optional(parser):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         output, rem = parser(i)
         if output.error():
             return ParseResult(i.loc, None), i
@@ -271,12 +489,14 @@ def optional(parser):
 # Runs a sequence of parsers, and returns a list of their outputs. Fails if any parser fails.
 def sequence(*parsers, custom_error_msg=None):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         loc = i.loc
         output = []
         for parser in parsers:
             parse_output, rem = parser(i)
             if parse_output.error():
-                if custom_error_msg is not None:
+                if custom_error_msg is not None and not i.lazy_errors:
                     return ParseError(i.loc, custom_error_msg, causes=[parse_output]), i
                 else:
                     return parse_output, i
@@ -291,6 +511,8 @@ def sequence(*parsers, custom_error_msg=None):
 # Applies a function to the returned value of a parser if it succeeds
 def parser_map(parser, map_fn):
     def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
         output, rem = parser(i)
         if not output.error():
             return ParseResult(output.loc, map_fn(output.value)), rem
@@ -309,52 +531,24 @@ def right(left_parser, right_parser):
     return parser_map(sequence(left_parser, right_parser), lambda output: output[1].value)
 
 
-def wrap_whitespace(parser):
-    return left(right(optional_whitespace, parser), optional_whitespace)
-
+# Read one keyword token and look it up (case-insensitively) in a keyword table.
+# If allowed is given, only objects in it are accepted.
+def parse_keyword(table, error_msg, allowed=None):
+    def parse_fn(i: ParserInput) -> (ParseResult, ParserInput):
+        if counters is not None:
+            counters.calls += 1
+        token = keyword_pattern.match(i.text, i.loc)
+        if token is not None:
+            obj = table.get(token.group(0).casefold())
+            if obj is not None and (allowed is None or obj in allowed):
+                return ParseResult(i.loc, obj), i.advance(token.end() - i.loc)
+        return i.error(error_msg), i
 
-def parse_any_string(*strings, error_msg):
-    return parse_any(*[parse_string(s) for s in strings], error_msg=error_msg)
+    return parse_fn
 
 
 def parse_mnemonic(instr_list, error_msg):
-    return parser_map(
-        parse_any_string(*[inst.name for inst in instr_list], error_msg=error_msg),
-        lambda name: get_obj_by_name(instr_list, name)
-    )
-
-
-whitespace_and_comment = one_or_more_of(parse_any(parse_whitespace, parse_comment, error_msg='whitespace or comment'))
-
-optional_whitespace = optional(whitespace_and_comment)
-
-parse_register = parser_map(
-    parse_any_string(*[r.name for r in registers], error_msg='register name'),
-    lambda name: get_obj_by_name(registers, name)
-)
-
-parse_r_type = sequence(
-    parse_mnemonic(r_instructions, error_msg='R-type instruction'),  # Instruction mnemonic, e.g. 'addi'
-    right(parse_whitespace, parse_register),  # Register rd (must have whitespace beforehand)
-    right(  # Ignore return value from comma, keep register
-        wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
-        parse_register  # Register rs
-    ),
-    right(  # Ignore return value from comma, keep register
-        wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
-        parse_register  # Register rt
-    ), )
-
-# Parse an R-type instruction that only uses two arguments (E.G. shift by one instructions).
-# The third argument is given as zero.
-parse_reduced_r_type = parser_map(sequence(
-    parse_mnemonic(reduced_r_instructions, '2-operand R-type instruction'),  # Instruction mnemonic, e.g. 'addi'
-    right(parse_whitespace, parse_register),  # Register rd (must have whitespace beforehand)
-    right(  # Ignore return value from comma, keep register
-        wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
-        parse_register  # Register rs
-    )
-), lambda out: out + [ParseResult(-1, registers[0])])
+    return parse_keyword(instruction_table, error_msg, allowed=set(instr_list))
 
 
 def flatten_list(lst):
@@ -368,45 +562,287 @@ def flatten_list(lst):
     return outlist
 
 
-parse_i_type = parser_map(sequence(
-    parse_mnemonic(i_instructions, error_msg='I-type instruction'),
-    right(parse_whitespace, parse_register),  # First register (must have whitespace beforehand)
-    right(  # Ignore return value from comma, keep register
-        wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
-
-        # Two different options for i-type syntax:
-        # addi $s1, $s2, imm
-        # sw $s1, 0($s2)
-        parse_any(
-            sequence(  # first option
-                parse_register,
-                right(  # Ignore return value from comma, keep value
-                    wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
-                    parse_any(parser_numeric_literal, parse_label, error_msg='numeric literal or label')  # immediate/label
-                )
-            ),
-            parser_map(  # Second option (parentheses)
-                sequence(
-                    parser_numeric_literal,
-                    left(right(wrap_whitespace(parse_string('(')), parse_register), wrap_whitespace(parse_string(')')))
-                ), lambda output: (output[1], output[0])  # Swap order since literal comes first
-            ),
-            error_msg='valid i-type arguments'
+# The combinator grammar is built the first time it is used rather than when this module is imported, since building
+# it creates a few hundred closures and short runs are dominated by startup. Runs that never call parse_item or
+# parse_asm (the fast path without fallbacks, cache hits) don't build it at all.
+grammar = None  # (parse_item, parse_asm) once built
+macro_grammar = None  # The same for macro bodies, where operands may also be macro parameters
+
+
+def build_grammar(parameters=False):
+    global grammar, macro_grammar
+    whitespace_and_comment = one_or_more_of(parse_any(parse_whitespace, parse_comment, error_msg='whitespace or comment'))
+
+    optional_whitespace = optional(whitespace_and_comment)
+
+    def wrap_whitespace(parser):
+        return left(right(optional_whitespace, parser), optional_whitespace)
+
+    parse_register = parse_keyword(register_table, error_msg='register name')
+    parse_value = parse_any(parser_numeric_literal, parse_label, error_msg='numeric literal or label')
+    parse_offset = parser_numeric_literal
+    if parameters:
+        parse_register = parse_any(parse_register, parse_parameter, error_msg='register name or macro parameter')
+        parse_value = parse_any(parse_value, parse_parameter, error_msg='numeric literal, label or macro parameter')
+        parse_offset = parse_any(parse_offset, parse_parameter, error_msg='numeric literal or macro parameter')
+
+    parse_r_type = sequence(
+        parse_mnemonic(r_instructions, error_msg='R-type instruction'),  # Instruction mnemonic, e.g. 'addi'
+        right(parse_whitespace, parse_register),  # Register rd (must have whitespace beforehand)
+        right(  # Ignore return value from comma, keep register
+            wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
+            parse_register  # Register rs
+        ),
+        right(  # Ignore return value from comma, keep register
+            wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
+            parse_register  # Register rt
+        ), )
+
+    # Parse an R-type instruction that only uses two arguments (E.G. shift by one instructions).
+    # The third argument is given as zero.
+    parse_reduced_r_type = parser_map(sequence(
+        parse_mnemonic(reduced_r_instructions, '2-operand R-type instruction'),  # Instruction mnemonic, e.g. 'addi'
+        right(parse_whitespace, parse_register),  # Register rd (must have whitespace beforehand)
+        right(  # Ignore return value from comma, keep register
+            wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
+            parse_register  # Register rs
+        )
+    ), lambda out: out + [ParseResult(-1, registers[0])])
+
+    parse_i_type = parser_map(sequence(
+        parse_mnemonic(i_instructions, error_msg='I-type instruction'),
+        right(parse_whitespace, parse_register),  # First register (must have whitespace beforehand)
+        right(  # Ignore return value from comma, keep register
+            wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
+
+            # Two different options for i-type syntax:
+            # addi $s1, $s2, imm
+            # sw $s1, 0($s2)
+            parse_any(
+                sequence(  # first option
+                    parse_register,
+                    right(  # Ignore return value from comma, keep value
+                        wrap_whitespace(parse_string(',')),  # Comma separating registers (plus any amount of whitespace)
+                        parse_value  # immediate/label
+                    )
+                ),
+                parser_map(  # Second option (parentheses)
+                    sequence(
+                        parse_offset,
+                        left(right(wrap_whitespace(parse_string('(')), parse_register), wrap_whitespace(parse_string(')')))
+                    ), lambda output: (output[1], output[0])  # Swap order since literal comes first
+                ),
+                error_msg='valid i-type arguments'
+            )
         )
+    ), lambda out: flatten_list(out))  # since this got hierarchical, un-hierarchy it
+
+    # J type is just a mnemonic plus literal/label
+    parse_j_type = sequence(
+        parse_mnemonic(j_instructions, error_msg='J-type instruction'),
+        right(parse_whitespace, parse_value)
     )
-), lambda out: flatten_list(out))  # since this got hierarchical, un-hierarchy it
 
-# J type is just a mnemonic plus literal/label
-parse_j_type = sequence(
-    parse_mnemonic(j_instructions, error_msg='J-type instruction'),
-    right(parse_whitespace, parse_any(parser_numeric_literal, parse_label, error_msg='numeric literal or label'))
-)
+    parse_nop = sequence(parse_mnemonic(nop_instructions, error_msg='NOP'))
+
+    parse_instruction = parse_any(parse_r_type, parse_reduced_r_type, parse_i_type, parse_j_type, parse_nop, error_msg='an instruction')
+
+    # Parse a label on a new line, with format "label: ...." or "label ...." (colon is optional)
+    line_label = left(parse_label, optional(parse_string(':')))
+
+    # A single instruction or label along with any whitespace/comments around it
+    parse_item = wrap_whitespace(parse_any(parse_instruction, line_label, error_msg='an instruction or label'))
+
+    parse_asm = parse_all(parse_item)
+
+    if parameters:
+        macro_grammar = parse_item, parse_asm
+        return macro_grammar
+    grammar = parse_item, parse_asm
+    return grammar
+
+
+# A single instruction or label along with any whitespace/comments around it
+def parse_item(i: ParserInput) -> (ParseResult, ParserInput):
+    return (grammar or build_grammar())[0](i)
+
+
+def parse_asm(i: ParserInput) -> (ParseResult, ParserInput):
+    return (grammar or build_grammar())[1](i)
+
+
+# Parse the body of a macro: the same as parse_asm, but operands may be macro parameters
+def parse_macro_body(i: ParserInput) -> (ParseResult, ParserInput):
+    return (macro_grammar or build_grammar(parameters=True))[1](i)
+
+
+# Line-oriented fast path.
+# Assembly has no nesting, so a well-formed line can be decoded directly: read the mnemonic, then match all of the
+# operands for its instruction class with one regex. Anything the fast path does not recognize (multi-line
+# instructions, malformed operands, ...) is handed to parse_item, so the output and error messages are the same as
+# parse_asm's.
+fast_register = r'(\$?[a-zA-Z0-9_]+)'
+fast_value = r'(-?[0-9A-Fxb]+|[a-zA-Z_][a-zA-Z0-9_]*)'  # Numeric literal or label
+fast_comma = r'[^\S\n]*,[^\S\n]*'
+fast_line_end = r'[^\S\n]*(?=[#;\n]|\Z)'  # Only a comment or the end of the line may follow the operands
 
-parse_nop = sequence(parse_mnemonic(nop_instructions, error_msg='NOP'))
+fast_skip_pattern = re.compile(r'(?:\s+|[#;][^\n]*)*')  # Whitespace and comments between items
+# Operand patterns, compiled when the fast path is first used (see build_fast_decoders)
+fast_r_operands = (r'[^\S\n]+' + fast_register + fast_comma + fast_register + fast_comma + fast_register
+                   + fast_line_end)
+fast_reduced_r_operands = r'[^\S\n]+' + fast_register + fast_comma + fast_register + fast_line_end
+fast_i_operands = (r'[^\S\n]+' + fast_register + fast_comma + '(?:' + fast_register + fast_comma + fast_value
+                   + r'|(-?[0-9A-Fxb]+)[^\S\n]*\([^\S\n]*' + fast_register + r'[^\S\n]*\))' + fast_line_end)
+fast_j_operands = r'[^\S\n]+' + fast_value + fast_line_end
+fast_nop_operands = fast_line_end
+
+# Convert a numeric literal or label operand, or return None if parse_asm would not accept it
+def fast_operand(token):
+    if token[0] == '-' or token[0].isdigit():
+        try:
+            return int(token, 0)
+        except ValueError:
+            return None
+    if token in reserved_names:
+        return None
+    return Label(token)
+
+
+# Decoders return the operands as ParseResults located at their tokens, with a value of None if an operand is invalid
+def fast_register_operand(match, group):
+    return ParseResult(match.start(group), register_table.get(match.group(group).casefold()))
+
+
+def fast_value_operand(match, group):
+    return ParseResult(match.start(group), fast_operand(match.group(group)))
+
+
+# The offset in imm(rs) can only be a numeric literal
+def fast_numeric_operand(match, group):
+    try:
+        return ParseResult(match.start(group), int(match.group(group), 0))
+    except ValueError:
+        return ParseResult(match.start(group), None)
+
+
+def fast_r_type(match):
+    return [fast_register_operand(match, 1), fast_register_operand(match, 2), fast_register_operand(match, 3)]
 
-parse_instruction = parse_any(parse_r_type, parse_reduced_r_type, parse_i_type, parse_j_type, parse_nop, error_msg='an instruction')
 
-# Parse a label on a new line, with format "label: ...." or "label ...." (colon is optional)
-line_label = left(parse_label, optional(parse_string(':')))
+def fast_reduced_r_type(match):
+    return [fast_register_operand(match, 1), fast_register_operand(match, 2), ParseResult(-1, registers[0])]
 
-parse_asm = parse_all(wrap_whitespace(parse_any(parse_instruction, line_label, error_msg='an instruction or label')))
+
+def fast_i_type(match):
+    if match.group(3) is not None:  # rt, rs, imm
+        return [fast_register_operand(match, 1), fast_register_operand(match, 2), fast_value_operand(match, 3)]
+    else:  # rt, imm(rs)
+        return [fast_register_operand(match, 1), fast_register_operand(match, 5), fast_numeric_operand(match, 4)]
+
+
+def fast_j_type(match):
+    return [fast_value_operand(match, 1)]
+
+
+def fast_nop(match):
+    return []
+
+
+# Pick the operand pattern and decoder for an instruction from its class
+def fast_decoder(instruction):
+    if instruction in reduced_r_instructions:
+        return fast_reduced_r_operands, fast_reduced_r_type
+    elif isinstance(instruction, RType):
+        return fast_r_operands, fast_r_type
+    elif isinstance(instruction, IType):
+        return fast_i_operands, fast_i_type
+    elif isinstance(instruction, JType):
+        return fast_j_operands, fast_j_type
+    else:
+        return fast_nop_operands, fast_nop
+
+
+fast_decoders = None  # Case-folded mnemonic -> (instruction, operand pattern, decoder), once built
+
+
+# Compiling the operand patterns is a noticeable part of startup, so it is only done once the fast path is used.
+# (re caches compiled patterns, so instructions of the same class share one pattern object.)
+def build_fast_decoders():
+    global fast_decoders
+    fast_decoders = {}
+    for name, instruction in instruction_table.items():
+        operands, decode = fast_decoder(instruction)
+        fast_decoders[name] = (instruction, re.compile(operands), decode)
+    return fast_decoders
+
+
+# Decode one instruction or label at loc. Returns the item and the location after it, or None if the fast path
+# can't handle it.
+def fast_item(text, loc):
+    token = keyword_pattern.match(text, loc)
+    if token is None:
+        return None
+
+    decoder = fast_decoders.get(token.group(0).casefold())
+    if decoder is not None:
+        instruction, pattern, decode = decoder
+        operands = pattern.match(text, token.end())
+        if operands is None:
+            return None
+        arguments = decode(operands)
+        if any(arg.value is None for arg in arguments):
+            return None
+        return ParseResult(loc, [ParseResult(loc, instruction)] + arguments), operands.end()
+
+    label = label_pattern.match(text, loc)
+    if label is None or label.group(0) in reserved_names:
+        return None
+    end = label.end()
+    if text.startswith(':', end):
+        end += 1
+    return ParseResult(loc, Label(label.group(0))), end
+
+
+# Same interface and output as parse_asm, but decodes well-formed lines directly and only runs the combinator parser
+# on lines it can't handle.
+def parse_asm_fast(i: ParserInput) -> (ParseResult, ParserInput):
+    if fast_decoders is None:
+        build_fast_decoders()
+    text = i.text
+    loc = fast_skip_pattern.match(text, i.loc).end()
+    if loc >= len(text):
+        # Nothing but whitespace/comments (or nothing at all), let parse_asm decide what that means
+        return parse_asm(i)
+
+    output = []
+    first_error = None
+    while loc < len(text):
+        item = fast_item(text, loc)
+        if counters is not None:
+            if item is None:
+                counters.fallback_items += 1
+            else:
+                counters.fast_items += 1
+        if item is None:
+            # Fall back to the combinator parser for this item
+            parse_output, rem = parse_item(ParserInput(text, loc, i.lazy_errors, lines=i.lines))
+            if parse_output.error():
+                if i.lazy_errors:
+                    parse_output, rem = parse_item(ParserInput(text, loc, lines=i.lines))
+                if i.errors is None:
+                    return parse_output, rem
+                # Record the error and resume at the next line
+                i.errors.append(parse_output)
+                if first_error is None:
+                    first_error = parse_output
+                loc = fast_skip_pattern.match(text, i.lines.next_line_start(parse_output.loc)).end()
+                continue
+            output.append(parse_output)
+            loc = rem.loc
+        else:
+            parse_output, loc = item
+            output.append(parse_output)
+            loc = fast_skip_pattern.match(text, loc).end()
+    if first_error is not None:
+        return first_error, i.advance(loc - i.loc)
+    return ParseResult(i.loc, output), i.advance(loc - i.loc)
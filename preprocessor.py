@@ -0,0 +1,535 @@
+from encoder import AssemblySyntaxError
+from image import Data, Org, Space, WORD_MAX, WORD_MIN, words_from_bytes
+from instructions import ADDRESS_INCREMENT, I_IMMEDIATE, REGISTER, mnemonics, reserved_names
+from parser import fast_skip_pattern, label_pattern, numeric_literal_pattern, parameter_pattern, parse_asm, \
+    parse_asm_fast, parse_macro_body, register_table, Label, LineIndex, Parameter, ParseError, ParseResult, ParserInput
+from registers import Register, registers
+
+from array import array
+from bisect import bisect_left
+import os
+import re
+
+# Preprocessor: .include, macros, pseudo-instructions and data directives, expanded into the items the Assembler takes.
+#
+#   .include "file.asm"          Assemble another file here (relative to the including file)
+#   .org 0x4000                  Put the following words at an address
+#   table: .word 1, -2, label    16-bit words (labels are replaced by their address)
+#   .fill 16, 0xFFFF             Count words of a value (default 0)
+#   .space 32                    Skip a number of bytes (a gap in the memory image, see image.py)
+#   .incbin "font.bin"           Words of a binary file (big-endian, padded to a whole word)
+#   .macro name a, b             Define a macro. Its body uses the parameters as \a and \b, in any operand position.
+#       add \a, \a, \b           Labels defined in the body are local to each expansion.
+#   .endm
+#   loop: name $s1, $s2          Expand a macro (or pseudo-instruction), optionally after a label
+#
+# Only lines starting with a directive or the name of a macro or pseudo-instruction are handled here. A source without
+# any of these lines is parsed exactly as before. Otherwise they are found with one regex search over the text and
+# blanked out, keeping every other character in place so error locations don't change, the rest of the file is parsed
+# in one go as usual and the expansions are merged back in by location.
+#
+# Macro bodies are parsed once, when they are defined, with the parameters left as placeholders: expanding a macro only
+# substitutes the arguments into the parsed items. Included files are preprocessed once per run, and their items are
+# reused wherever the same file is included again. Macros must be defined before they are used, and can't be defined
+# twice (including a file of macros again is fine, it defines the same macros).
+
+DIRECTIVES = ['.include', '.macro', '.endm', '.org', '.word', '.fill', '.space', '.incbin']
+
+comment_start_pattern = re.compile('[#;]')
+include_pattern = re.compile(r'^[ \t]*(?:[a-zA-Z_][a-zA-Z0-9_]*[ \t]*:[ \t]*)?\.inc(?:lude|bin)\b',
+                             re.MULTILINE | re.IGNORECASE)
+include_argument_pattern = re.compile(r'[ \t]*"([^"\n]*)"[ \t]*$')
+macro_header_pattern = re.compile(r'[ \t]+([a-zA-Z_][a-zA-Z0-9_]*)((?:[ \t]*,?[ \t]*[a-zA-Z_][a-zA-Z0-9_]*)*)[ \t]*$')
+identifier_pattern = re.compile('[a-zA-Z_][a-zA-Z0-9_]*')
+
+# Registers are 16 bits wide (WORD_MIN to WORD_MAX), and addi can add up to I_IMMEDIATE.max (in chunks of CHUNK_BITS
+# when loading bigger values)
+CHUNK_BITS = I_IMMEDIATE.width - 1
+
+zero = registers[0]
+
+
+# Raised while expanding a macro, and reported at the line that invoked it
+class ExpansionError(Exception):
+    pass
+
+
+# li rt, value: load a 16-bit value. Small values take one addi; bigger ones are built CHUNK_BITS at a time with addi
+# and asl1 (no other register is touched).
+def expand_li(new_label, rt, value):
+    if not WORD_MIN <= value <= WORD_MAX:
+        raise ExpansionError('a 16-bit value for li, not {}'.format(value))
+    value = ((value & 0xFFFF) ^ 0x8000) - 0x8000
+    if I_IMMEDIATE.min <= value <= I_IMMEDIATE.max:
+        return [('addi', [rt, zero, value])]
+    chunks = 1 if I_IMMEDIATE.min <= value >> CHUNK_BITS <= I_IMMEDIATE.max else 2
+    code = [('addi', [rt, zero, value >> (chunks * CHUNK_BITS)])]
+    for n in reversed(range(chunks)):
+        code += [('asl1', [rt, rt, zero])] * CHUNK_BITS
+        chunk = (value >> (n * CHUNK_BITS)) & ((1 << CHUNK_BITS) - 1)
+        if chunk:
+            code.append(('addi', [rt, rt, chunk]))
+    return code
+
+
+# mov rd, rs: copy a register
+def expand_mov(new_label, rd, rs):
+    return [('add', [rd, rs, zero])]
+
+
+# beq rt, rs, target: branch if equal, by skipping a jump when the registers differ (so the target can be anywhere j
+# can reach)
+def expand_beq(new_label, rt, rs, target):
+    skip = new_label('skip')
+    return [('bne', [rt, rs, skip]), ('j', [target]), skip]
+
+
+# Argument kinds of pseudo-instructions
+NUMBER = 'number'
+TARGET = 'target'  # Number or label
+
+# Name -> (argument kinds, expansion function). Expansion functions return a list of (mnemonic, operands) and Labels.
+PSEUDO_INSTRUCTIONS = {
+    'li': ([REGISTER, NUMBER], expand_li),
+    'mov': ([REGISTER, REGISTER], expand_mov),
+    'beq': ([REGISTER, REGISTER, TARGET], expand_beq),
+}
+
+KIND_NAMES = {REGISTER: 'a register', NUMBER: 'a number', TARGET: 'a number or label'}
+
+
+# Argument values of a data directive that only takes numbers, from min_count to max_count of them
+def number_arguments(usage, arguments, min_count, max_count):
+    values = [argument.value for argument in arguments]
+    if not min_count <= len(values) <= max_count or not all(isinstance(value, int) for value in values):
+        raise ExpansionError(usage)
+    return values
+
+
+def directive_org(arguments):
+    address, = number_arguments('.org ADDRESS', arguments, 1, 1)
+    if address < 0 or address % ADDRESS_INCREMENT:
+        raise ExpansionError('a non-negative address that is a multiple of {} for .org'.format(ADDRESS_INCREMENT))
+    return Org(address)
+
+
+def directive_space(arguments):
+    size, = number_arguments('.space SIZE', arguments, 1, 1)
+    if size < 0 or size % ADDRESS_INCREMENT:
+        raise ExpansionError('a non-negative size that is a multiple of {} for .space'.format(ADDRESS_INCREMENT))
+    return Space(size)
+
+
+def directive_fill(arguments):
+    values = number_arguments('.fill COUNT[, VALUE]', arguments, 1, 2)
+    count, value = values[0], values[1] if len(values) > 1 else 0
+    if count < 0 or not WORD_MIN <= value <= WORD_MAX:
+        raise ExpansionError('a non-negative count and a 16-bit value for .fill')
+    return Data(array('H', [value & 0xFFFF]) * count)
+
+
+def directive_word(arguments):
+    words = []
+    for argument in arguments:
+        if isinstance(argument.value, Label):
+            words.append(argument.value)
+        elif isinstance(argument.value, int) and WORD_MIN <= argument.value <= WORD_MAX:
+            words.append(argument.value & 0xFFFF)
+        else:
+            raise ExpansionError('16-bit numbers or labels for .word')
+    if not words:
+        raise ExpansionError('.word VALUE[, VALUE...]')
+    # Words without labels are stored as an array, like the other data directives
+    return Data(words if any(isinstance(word, Label) for word in words) else array('H', words))
+
+
+# Data directives taking comma separated arguments: name -> function returning the item (.incbin takes a file name)
+DATA_DIRECTIVES = {
+    '.org': directive_org,
+    '.word': directive_word,
+    '.fill': directive_fill,
+    '.space': directive_space,
+}
+
+
+# True if the text has an .include or .incbin directive, whose files the text alone doesn't identify (e.g. for caching)
+def uses_includes(text):
+    return include_pattern.search(text) is not None
+
+
+# True if the text needs the preprocessor at all
+def needs_preprocessing(text):
+    return Preprocessor().pattern.search(text) is not None
+
+
+# The first item's location can include the whitespace and comments (and blanked lines) before it, as the parser
+# starts it where the text starts. Moves it to the item itself, so it is on the item's line (see listing.py).
+def skip_leading_whitespace(text, items):
+    if items:
+        items[0] = ParseResult(fast_skip_pattern.match(text, items[0].loc).end(), items[0].value)
+    return items
+
+
+class Macro:
+    def __init__(self, name, parameters, items, local_labels):
+        self.name = name
+        self.parameters = parameters  # Parameter names, in order
+        self.items = items  # Parsed body: ParseResults (operands may be Parameters) and Invocations
+        self.local_labels = local_labels  # Labels defined in the body
+
+
+# A macro or pseudo-instruction used in a file or a macro body
+class Invocation:
+    __slots__ = ('loc', 'name', 'arguments')
+
+    def __init__(self, loc, name, arguments):
+        self.loc = loc
+        self.name = name  # Case-folded
+        self.arguments = arguments  # ParseResults of Registers, numbers, Labels or (in a macro body) Parameters
+
+
+class Preprocessor:
+    def __init__(self, fast=True, all_errors=False):
+        self.fast = fast
+        self.all_errors = all_errors
+        self.macros = {}  # Case-folded name -> Macro
+        self.includes = {}  # Real path -> (items, {name: Macro} defined by the file, {name: Macro} it used)
+        self.including = []  # Real paths of the files being preprocessed, to catch include cycles
+        self.used = [{}]  # Macros used by each file being preprocessed, innermost last
+        self.expansions = 0  # Used to give the local labels of every expansion unique names
+        self.pattern = None
+        self.build_pattern()
+
+    # Lines this preprocessor handles: an optional label, then a directive, macro or pseudo-instruction name.
+    # Pseudo-instructions always take arguments, so their names are only matched before one: a line with just li, mov
+    # or beq (with or without a colon) is a label, as it is without preprocessing.
+    def build_pattern(self):
+        names = [r'\.[a-zA-Z_]+'] + [re.escape(name) for name in sorted(self.macros, key=len, reverse=True)]
+        pseudo_names = [re.escape(name) for name in sorted(PSEUDO_INSTRUCTIONS, key=len, reverse=True)]
+        self.pattern = re.compile(r'^[ \t]*(?:([a-zA-Z_][a-zA-Z0-9_]*)[ \t]*:[ \t]*)?((?:' + '|'.join(names)
+                                  + r')(?=[ \t\r#;]|$)|(?:' + '|'.join(pseudo_names) + r')(?=[ \t]+[^\s#;:]))',
+                                  re.MULTILINE | re.IGNORECASE)
+
+    # Preprocess and parse the text of the file at path (None if it isn't a file). Returns the list of items.
+    # Raises AssemblySyntaxError.
+    def process(self, text, path=None):
+        return self.process_file(text, path, None)
+
+    # display_path is the path shown in error messages, None for the file being assembled
+    def process_file(self, text, path, display_path):
+        # Directives and pseudo-instructions never parse as assembly (they can't have the name of an instruction, and
+        # pseudo-instructions take registers), so until a macro is defined, a source that parses doesn't need anything
+        # else and is only searched for them if the parse failed. A macro invocation can parse, though: with no
+        # arguments or only labels, it reads as label definitions. Once there are macros (e.g. from an included file),
+        # sources are always searched. If nothing is found, a parse error is reported as usual.
+        parse_fn = parse_asm_fast if self.fast else parse_asm
+        parse_input = ParserInput(text, lazy_errors=True, errors=[] if self.all_errors else None)
+        ast, rem = parse_fn(parse_input)
+        if not ast.error() and not self.macros:
+            return skip_leading_whitespace(text, ast.value)
+        if self.pattern.search(text) is None:
+            if not ast.error():
+                return skip_leading_whitespace(text, ast.value)
+            raise AssemblySyntaxError(parse_input, ast, display_path)
+
+        def fail(loc, error_msg):
+            raise AssemblySyntaxError(ParserInput(text), ParseError(loc, error_msg), display_path)
+
+        base = os.path.dirname(path) if path is not None else ''
+        specials = []  # (start, end, items) of every line handled here, and the items it expands to
+        definition = None  # [name, parameters, header start, body start, invocations] of the macro being defined
+        pos = 0
+        while True:
+            match = self.pattern.search(text, pos)
+            if match is None:
+                break
+            line_start = match.start()
+            line_end = text.find('\n', match.end())
+            if line_end == -1:
+                line_end = len(text)
+            pos = line_end
+            comment = comment_start_pattern.search(text, match.end(), line_end)
+            arguments_end = comment.start() if comment is not None else line_end
+            label, name = match.group(1), match.group(2)
+            keyword = name.casefold()
+            items = []
+            if label is not None:
+                if label in reserved_names:
+                    fail(match.start(1), 'label')
+                items.append(ParseResult(match.start(1), Label(label)))
+
+            if keyword == '.macro':
+                if definition is not None:
+                    fail(match.start(2), '.endm before the next .macro')
+                if label is not None:
+                    fail(match.start(1), 'no label before .macro')
+                header = macro_header_pattern.match(text, match.end(), arguments_end)
+                if header is None:
+                    fail(match.end(), 'macro name and parameters')
+                macro_name = header.group(1)
+                if macro_name.casefold() in self.macros or self.reserved(macro_name):
+                    fail(header.start(1), 'a macro name that isn\'t already used')
+                parameters = identifier_pattern.findall(header.group(2))
+                if len(set(parameters)) != len(parameters):
+                    fail(header.start(2), 'different parameter names')
+                definition = [macro_name, parameters, line_start, min(line_end + 1, len(text)), []]
+            elif keyword == '.endm':
+                if definition is None:
+                    fail(match.start(2), '.macro before .endm')
+                if label is not None:
+                    fail(match.start(1), 'no label before .endm')
+                macro_name, parameters, header_start, body_start, invocations = definition
+                macro = self.parse_macro(text, display_path, macro_name, parameters, body_start, line_start,
+                                         invocations)
+                self.define(macro)
+                specials.append((header_start, line_end, []))
+                definition = None
+            elif keyword == '.include':
+                if definition is not None:
+                    fail(match.start(2), '.endm before .include')
+                argument = include_argument_pattern.match(text, match.end(), arguments_end)
+                if argument is None:
+                    fail(match.end(), 'a quoted file name')
+                include_path = os.path.join(base, argument.group(1))
+                try:
+                    # The included items are at the .include line (their locations are in the included file)
+                    items += [ParseResult(match.start(2), item.value) for item in self.include(include_path)]
+                except OSError as e:
+                    fail(argument.start(1), 'a file that can be read ({})'.format(e.strerror))
+                except ExpansionError as e:
+                    fail(argument.start(1), str(e))
+                specials.append((line_start, line_end, items))
+            elif keyword in DATA_DIRECTIVES or keyword == '.incbin':
+                if definition is not None:
+                    fail(match.start(2), '.endm before {} (data directives can\'t be used in macros)'.format(keyword))
+                if keyword == '.incbin':
+                    argument = include_argument_pattern.match(text, match.end(), arguments_end)
+                    if argument is None:
+                        fail(match.end(), 'a quoted file name')
+                    try:
+                        with open(os.path.join(base, argument.group(1)), 'rb') as binary_file:
+                            items.append(ParseResult(match.start(2), Data(words_from_bytes(binary_file.read()))))
+                    except OSError as e:
+                        fail(argument.start(1), 'a file that can be read ({})'.format(e.strerror))
+                else:
+                    arguments = self.parse_arguments(text, match.end(), arguments_end, fail, False)
+                    try:
+                        items.append(ParseResult(match.start(2), DATA_DIRECTIVES[keyword](arguments)))
+                    except ExpansionError as e:
+                        fail(match.start(2), str(e))
+                specials.append((line_start, line_end, items))
+            elif keyword.startswith('.'):
+                fail(match.start(2), 'a directive ({})'.format(', '.join(DIRECTIVES)))
+            else:
+                invocation = Invocation(match.start(2), keyword,
+                                        self.parse_arguments(text, match.end(), arguments_end, fail,
+                                                             definition is not None))
+                if definition is not None:
+                    # Locations in a macro body are relative to its start (except for invocations, which are
+                    # reported where they are in the file)
+                    items = [ParseResult(item.loc - definition[3], item.value) for item in items]
+                    definition[4].append((line_start, line_end, items, invocation))
+                    continue
+                try:
+                    items += self.expand(invocation)
+                except ExpansionError as e:
+                    fail(invocation.loc, str(e))
+                specials.append((line_start, line_end, items))
+
+        if definition is not None:
+            fail(definition[2], '.endm for this macro')
+        return self.merge(text, specials, parse_fn, display_path)
+
+    # Blank out the special lines, parse the rest and insert the items of every special line where it was.
+    def merge(self, text, specials, parse_fn, display_path, first_line=1):
+        pieces = []
+        pos = 0
+        for start, end, items in specials:
+            pieces.append(text[pos:start])
+            pieces.append(' ' * (end - start))
+            pos = end
+        pieces.append(text[pos:])
+        masked = ''.join(pieces)
+
+        parsed = []
+        if fast_skip_pattern.match(masked).end() < len(masked):
+            parse_input = ParserInput(masked, lazy_errors=True, errors=[] if self.all_errors else None,
+                                      lines=LineIndex(masked, first_line))
+            ast, rem = parse_fn(parse_input)
+            if ast.error():
+                raise AssemblySyntaxError(parse_input, ast, display_path)
+            parsed = skip_leading_whitespace(masked, ast.value)
+
+        result = []
+        index = 0
+        for start, end, items in specials:
+            next_index = bisect_left(parsed, start, index, key=lambda item: item.loc)
+            result += parsed[index:next_index]
+            result += items
+            index = next_index
+        result += parsed[index:]
+        return result
+
+    # Parse a macro body once. Invocations in the body (of macros defined earlier or pseudo-instructions) are kept as
+    # Invocations, to be expanded with the macro.
+    def parse_macro(self, text, display_path, name, parameters, body_start, body_end, invocations):
+        body = text[body_start:body_end]
+        specials = [(start - body_start, end - body_start, items + [invocation])
+                    for start, end, items, invocation in invocations]
+        first_line = text.count('\n', 0, body_start) + 1
+        items = self.merge(body, specials, parse_macro_body, display_path, first_line)
+
+        local_labels = set()
+        for item in items:
+            if isinstance(item, Invocation):
+                operands = item.arguments
+            elif isinstance(item.value, Label):
+                if item.value in local_labels:
+                    raise AssemblySyntaxError(ParserInput(text), ParseError(body_start + item.loc, 'label {} to be '
+                                              'defined once in macro {}'.format(item.value.name, name)), display_path)
+                local_labels.add(item.value)
+                continue
+            else:
+                operands = item.value[1:]
+            for operand in operands:
+                if isinstance(operand.value, Parameter) and operand.value.name not in parameters:
+                    loc = operand.loc if isinstance(item, Invocation) else body_start + operand.loc
+                    raise AssemblySyntaxError(ParserInput(text), ParseError(
+                        loc, 'a parameter of macro {} ({})'.format(name, ', '.join(parameters) or 'none')),
+                        display_path)
+        return Macro(name, parameters, items, local_labels)
+
+    # Parse the comma separated arguments of an invocation in text[start:end]
+    def parse_arguments(self, text, start, end, fail, in_macro):
+        arguments = []
+        if not text[start:end].strip():
+            return arguments
+        for argument in re.finditer('[^,]*', text[start:end]):
+            if argument.start() > 0 and text[start + argument.start() - 1] != ',':
+                continue  # finditer also returns the empty match right after each argument
+            token = argument.group(0).strip()
+            loc = start + argument.start() + len(argument.group(0)) - len(argument.group(0).lstrip())
+            if token.startswith('$'):
+                value = register_table.get(token.casefold())
+            elif token.startswith('\\') and in_macro:
+                parameter = parameter_pattern.fullmatch(token)
+                value = Parameter(parameter.group(1)) if parameter is not None else None
+            else:
+                # Like parse_value: a number if it is one, otherwise a label (x, FF and BEEF are labels)
+                value = None
+                if numeric_literal_pattern.fullmatch(token):
+                    try:
+                        value = int(token, 0)
+                    except ValueError:
+                        pass
+                if value is None and label_pattern.fullmatch(token) and token not in reserved_names:
+                    value = Label(token)
+            if value is None:
+                fail(loc, 'a register, number or label' + (' or macro parameter' if in_macro else ''))
+            arguments.append(ParseResult(loc, value))
+        return arguments
+
+    def reserved(self, name):
+        folded = name.casefold()
+        return folded in mnemonics or folded in register_table or folded in PSEUDO_INSTRUCTIONS
+
+    def define(self, macro):
+        key = macro.name.casefold()
+        if self.macros.get(key) is not macro:
+            self.macros[key] = macro
+            self.build_pattern()
+
+    # Returns the items of an included file, preprocessing it only the first time it is included (or if it uses a
+    # macro that has changed since)
+    def include(self, path):
+        real_path = os.path.realpath(path)
+        cached = self.includes.get(real_path)
+        if cached is not None:
+            items, defined, used = cached
+            if all(self.macros.get(name) is macro for name, macro in used.items()):
+                for name, macro in defined.items():
+                    if self.macros.get(name, macro) is not macro:
+                        raise ExpansionError('a file that doesn\'t redefine macro {}'.format(macro.name))
+                for macro in defined.values():
+                    self.define(macro)
+                self.used[-1].update(used)
+                return items
+        if real_path in self.including:
+            raise ExpansionError('a file that doesn\'t include itself')
+        with open(path, 'r') as include_file:
+            text = include_file.read()
+        before = dict(self.macros)
+        self.including.append(real_path)
+        self.used.append({})
+        try:
+            items = self.process_file(text, path, path)
+        finally:
+            self.including.pop()
+            used = self.used.pop()
+        defined = {name: macro for name, macro in self.macros.items() if before.get(name) is not macro}
+        used = {name: macro for name, macro in used.items() if name not in defined}
+        self.used[-1].update(used)
+        self.includes[real_path] = (items, defined, used)
+        return items
+
+    # Expand an invocation into items. bindings maps parameter names to arguments and renamed maps local labels to
+    # their names in this expansion, when expanding an invocation in a macro body.
+    def expand(self, invocation, bindings=None, renamed=None):
+        arguments = [self.substitute(argument.value, bindings, renamed) for argument in invocation.arguments]
+        loc = invocation.loc
+        self.expansions += 1
+        expansion = self.expansions
+
+        pseudo = PSEUDO_INSTRUCTIONS.get(invocation.name)
+        if pseudo is not None:
+            kinds, expand_fn = pseudo
+            if len(arguments) != len(kinds):
+                raise ExpansionError('{} argument{} for {}'.format(len(kinds), '' if len(kinds) == 1 else 's',
+                                                                  invocation.name))
+            for n, (kind, argument) in enumerate(zip(kinds, arguments)):
+                if (kind == REGISTER) != isinstance(argument, Register) or (kind == NUMBER and
+                                                                           not isinstance(argument, int)):
+                    raise ExpansionError('{} as argument {} of {}'.format(KIND_NAMES[kind], n + 1, invocation.name))
+            code = expand_fn(lambda name: Label('{}@{}'.format(name, expansion)), *arguments)
+            items = []
+            for entry in code:
+                if isinstance(entry, Label):
+                    items.append(ParseResult(loc, entry))
+                else:
+                    mnemonic, operands = entry
+                    items.append(ParseResult(loc, [ParseResult(loc, mnemonics[mnemonic])]
+                                             + [ParseResult(loc, operand) for operand in operands]))
+            return items
+
+        macro = self.macros[invocation.name]
+        self.used[-1][invocation.name] = macro
+        if len(arguments) != len(macro.parameters):
+            raise ExpansionError('{} argument{} for macro {}'.format(
+                len(macro.parameters), '' if len(macro.parameters) == 1 else 's', macro.name))
+        bindings = dict(zip(macro.parameters, arguments))
+        renamed = {label: Label('{}@{}'.format(label.name, expansion)) for label in macro.local_labels}
+        items = []
+        for item in macro.items:
+            if isinstance(item, Invocation):
+                items += self.expand(item, bindings, renamed)
+            elif isinstance(item.value, Label):
+                items.append(ParseResult(loc, renamed[item.value]))
+            else:
+                instruction = item.value[0].value
+                operands = [self.substitute(operand.value, bindings, renamed) for operand in item.value[1:]]
+                for n, (field_name, kind) in enumerate(instruction.format.operands):
+                    if (kind == REGISTER) != isinstance(operands[n], Register):
+                        raise ExpansionError('{} as operand {} of {} in macro {}'.format(
+                            'a register' if kind == REGISTER else 'a number or label', n + 1, instruction.name,
+                            macro.name))
+                items.append(ParseResult(loc, [ParseResult(loc, instruction)]
+                                         + [ParseResult(loc, operand) for operand in operands]))
+        return items
+
+    @staticmethod
+    def substitute(value, bindings, renamed):
+        if isinstance(value, Parameter):
+            return bindings[value.name]
+        if isinstance(value, Label) and renamed:
+            return renamed.get(value, value)
+        return value
@@ -0,0 +1,156 @@
+from encoder import directive_end
+from image import Org
+from instructions import ADDRESS_INCREMENT, PC_RELATIVE, mnemonics
+from parser import Label, ParseResult
+
+from bisect import bisect_right
+
+# Branch relaxation (--relax): branches whose target is out of range of their offset field are rewritten as
+#   bne $s0, $s1, far            bne $s0, $s1, over       # Taken: jump to far
+#                           ->   j after                  # Not taken: carry on after the sequence
+#                                over: j far
+#                                after:
+# There are no inverted branches (beq, bge) in the instruction set to make this two instructions, so it takes three.
+#
+# Growing a branch moves everything after it in its segment (up to the next .org), which can push other branches out
+# of range, so the layout is iterated until nothing changes. Rather than recomputing every address on each iteration,
+# the words added so far are kept in a Fenwick tree over the items: an address is its address without relaxation
+# plus a prefix sum. Only branches that are out of range are put on the worklist; when one grows, the only branches
+# that can be affected are the ones spanning it, which are within one branch range of it, so just those are checked
+# again. Branches only ever grow, so this always terminates, after at most one growth per branch.
+
+
+# Sums of values added at positions, over every position before some index, in O(log n)
+class PrefixSums:
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, index, value):
+        index += 1
+        tree = self.tree
+        while index < len(tree):
+            tree[index] += value
+            index += index & -index
+
+    # Sum of the values at positions before index
+    def before(self, index):
+        total = 0
+        tree = self.tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+
+# Offset field of an instruction's PC-relative operand if it is its last operand (a branch), otherwise None
+def branch_field(instruction):
+    operands = instruction.format.operands
+    if operands and operands[-1][1] == PC_RELATIVE:
+        return instruction.format.fields[operands[-1][0]]
+    return None
+
+
+# Returns the items with every branch whose label is out of range replaced by a branch over a jump, and the number of
+# branches that were replaced. Branches to numeric addresses and to undefined labels are left for the Assembler to
+# report.
+def relax_branches(items):
+    # Layout without relaxation: the address of every item and the index of the .org item its segment starts at
+    static = []
+    segment_of = []
+    label_positions = {}
+    address = 0
+    segment = 0
+    for index, item in enumerate(items):
+        value = item.value
+        static.append(address)
+        segment_of.append(segment)
+        if isinstance(value, Label):
+            label_positions.setdefault(value, index)
+        elif hasattr(value, '__iter__'):
+            address += ADDRESS_INCREMENT
+        else:
+            if isinstance(value, Org):
+                segment = index
+            address = directive_end(value, address)
+
+    # Branches to labels: positions (sorted), targets and offset fields
+    branches = []
+    targets = {}
+    fields = {}
+    for index, item in enumerate(items):
+        value = item.value
+        if hasattr(value, '__iter__') and isinstance(value[-1].value, Label):
+            field = branch_field(value[0].value)
+            target = label_positions.get(value[-1].value)
+            if field is not None and target is not None:
+                branches.append(index)
+                targets[index] = target
+                fields[index] = field
+    if not branches:
+        return items, 0
+    # A branch further than this from its target is out of range
+    reach = (max(max(-field.min, field.max + 1) for field in fields.values()) + 1) * ADDRESS_INCREMENT
+    cross_segment = [branch for branch in branches if segment_of[targets[branch]] != segment_of[branch]]
+
+    added = PrefixSums(len(items))
+    long_branches = set()
+
+    def address_of(index):
+        if not long_branches:
+            return static[index]
+        return static[index] + added.before(index) - added.before(segment_of[index])
+
+    def in_range(branch):
+        offset = (address_of(targets[branch]) - address_of(branch) - ADDRESS_INCREMENT) // ADDRESS_INCREMENT
+        return fields[branch].min <= offset <= fields[branch].max
+
+    worklist = [branch for branch in branches if not in_range(branch)]
+    while worklist:
+        branch = worklist.pop()
+        if branch in long_branches or in_range(branch):
+            continue
+        long_branches.add(branch)
+        added.add(branch, 2 * ADDRESS_INCREMENT)
+
+        # Branches in the same segment that span this one: earlier ones with a later target and later ones with an
+        # earlier target. Relaxing only moves items apart, so the ones that are further away than reach without
+        # relaxation were out of range from the start and are already on the worklist.
+        segment = segment_of[branch]
+        branch_address = static[branch]
+        position = bisect_right(branches, branch)
+        n = position - 2
+        while n >= 0 and segment_of[branches[n]] == segment and branch_address - static[branches[n]] <= reach:
+            other = branches[n]
+            if targets[other] > branch and other not in long_branches:
+                worklist.append(other)
+            n -= 1
+        n = position
+        while n < len(branches) and segment_of[branches[n]] == segment and \
+                static[branches[n]] - branch_address <= reach:
+            other = branches[n]
+            if targets[other] <= branch and other not in long_branches:
+                worklist.append(other)
+            n += 1
+        # Branches between segments move only at one end (rare, so all of them are checked)
+        worklist.extend(other for other in cross_segment if other not in long_branches)
+
+    if not long_branches:
+        return items, 0
+
+    jump = mnemonics['j']
+    relaxed = []
+    for index, item in enumerate(items):
+        if index not in long_branches:
+            relaxed.append(item)
+            continue
+        loc = item.loc
+        over = Label('@over{}'.format(index))
+        after = Label('@after{}'.format(index))
+        relaxed += [
+            ParseResult(loc, item.value[:-1] + [ParseResult(loc, over)]),
+            ParseResult(loc, [ParseResult(loc, jump), ParseResult(loc, after)]),
+            ParseResult(loc, over),
+            ParseResult(loc, [ParseResult(loc, jump), item.value[-1]]),
+            ParseResult(loc, after),
+        ]
+    return relaxed, len(long_branches)
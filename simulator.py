@@ -0,0 +1,230 @@
+from instructions import ADDRESS_INCREMENT, all_instructions, Branch, JType, OPCODE, FUNCT, RType
+from registers import registers
+
+import argparse
+import sys
+import time
+
+# Instruction-set simulator for the machine code produced by the assembler.
+# Instruction words are decoded once, and each basic block (a run of instructions ending at a branch, jump or halt) is
+# compiled into a Python function the first time it is reached, like the encoders in instructions.py. Running a
+# program is then one function call per basic block. Instruction memory is the program itself and can't be written,
+# so compiled blocks never go stale.
+#
+# Registers and data memory hold unsigned 16-bit values. $zero always reads 0. Data memory is a separate array of
+# 16-bit words addressed by rs + imm (wrapping at 16 bits). Opcode 0b111 stops the simulation: nop and halt assemble
+# to the same word, so both halt.
+
+MEMORY_WORDS = 1 << 16
+
+
+class SimulationError(Exception):
+    pass
+
+
+# Python statement for each instruction, using r (registers), mem (data memory) and the decoded fields. s() converts
+# a register value to a signed number.
+SEMANTICS = {
+    'add': 'r[{rd}] = (r[{rs}] + r[{rt}]) & 0xFFFF',
+    'sub': 'r[{rd}] = (r[{rs}] - r[{rt}]) & 0xFFFF',
+    'asl': 'r[{rd}] = (r[{rs}] << r[{rt}]) & 0xFFFF if r[{rt}] < 16 else 0',
+    'asr': 'r[{rd}] = (s(r[{rs}]) >> r[{rt}]) & 0xFFFF',
+    'and': 'r[{rd}] = r[{rs}] & r[{rt}]',
+    'nor': 'r[{rd}] = ~(r[{rs}] | r[{rt}]) & 0xFFFF',
+    'or': 'r[{rd}] = r[{rs}] | r[{rt}]',
+    'slt': 'r[{rd}] = 1 if s(r[{rs}]) < s(r[{rt}]) else 0',
+    'sll': 'r[{rd}] = (r[{rs}] << r[{rt}]) & 0xFFFF if r[{rt}] < 16 else 0',
+    'srl': 'r[{rd}] = r[{rs}] >> r[{rt}]',
+    'xor': 'r[{rd}] = r[{rs}] ^ r[{rt}]',
+    'asl1': 'r[{rd}] = (r[{rs}] << 1) & 0xFFFF',
+    'asr1': 'r[{rd}] = (s(r[{rs}]) >> 1) & 0xFFFF',
+    'addi': 'r[{rt}] = (r[{rs}] + {imm}) & 0xFFFF',
+    'lw': 'r[{rt}] = mem[(r[{rs}] + {imm}) & 0xFFFF]',
+    'sw': 'mem[(r[{rs}] + {imm}) & 0xFFFF] = r[{rt}]',
+}
+
+# Condition for each branch, taken when true
+BRANCH_CONDITIONS = {
+    'bne': 'r[{rt}] != r[{rs}]',
+    'blt': 's(r[{rt}]) < s(r[{rs}])',
+}
+
+HALT_OPCODE = 0b111
+
+# Instruction for each (opcode, funct), funct is None for instructions without one
+decode_table = {}
+for instruction in all_instructions:
+    funct = instruction.funct if isinstance(instruction, RType) else None
+    decode_table.setdefault((instruction.opcode, funct), instruction)
+
+
+def signed(value):
+    return (value ^ 0x8000) - 0x8000
+
+
+# Instruction and field values of an instruction word
+def decode(word):
+    opcode = (word >> OPCODE.position) & OPCODE.mask
+    instruction = decode_table.get((opcode, (word >> FUNCT.position) & FUNCT.mask)) or decode_table.get((opcode, None))
+    if instruction is None:
+        return None, {}
+    fields = {}
+    for name, field in instruction.format.fields.items():
+        value = (word >> field.position) & field.mask
+        if field.signed and value > field.max:
+            value -= 1 << field.width
+        fields[name] = value
+    return instruction, fields
+
+
+# A compiled basic block: run(r, mem) executes it and returns the address of the next instruction, or None if it
+# halted. count is the number of instructions in the block.
+class Block:
+    def __init__(self, run, count, end):
+        self.run = run
+        self.count = count
+        self.end = end  # Address of the last instruction in the block
+
+
+def compile_block(program, start):
+    lines = ['def run(r, mem):']
+    address = start
+    end = len(program) * ADDRESS_INCREMENT
+    result = None
+    while address < end:
+        word = program[address // ADDRESS_INCREMENT]
+        instruction, fields = decode(word)
+        if instruction is None:
+            raise SimulationError('Invalid instruction 0x{:04x} at address {}'.format(word, address))
+        next_address = address + ADDRESS_INCREMENT
+        if instruction.opcode == HALT_OPCODE:
+            result = 'None'
+            break
+        elif isinstance(instruction, Branch):
+            target = next_address + fields['imm'] * ADDRESS_INCREMENT
+            lines.append('    if {}: return {}'.format(BRANCH_CONDITIONS[instruction.name].format(**fields), target))
+            result = str(next_address)
+            break
+        elif isinstance(instruction, JType):
+            result = str(fields['imm'] * ADDRESS_INCREMENT)
+            break
+        statement = SEMANTICS[instruction.name].format(**fields)
+        # Writes to $zero are dropped (sw writes memory, not a register)
+        if instruction.name == 'sw' or not statement.startswith('r[0] ='):
+            lines.append('    ' + statement)
+        address = next_address
+    else:
+        # Ran to the end of the program
+        address -= ADDRESS_INCREMENT
+        result = str(end)
+    lines.append('    return ' + result)
+
+    namespace = {'s': signed}
+    exec('\n'.join(lines), namespace)
+    return Block(namespace['run'], (address - start) // ADDRESS_INCREMENT + 1, address)
+
+
+class Simulator:
+    def __init__(self, machine_code):
+        self.program = list(machine_code)
+        self.registers = [0] * len(registers)
+        self.memory = [0] * MEMORY_WORDS
+        self.pc = 0
+        self.steps = 0  # Instructions executed
+        self.halted = False
+        self.blocks = {}  # Start address -> Block
+
+    # Run until the program halts, runs off the end of the program or has executed max_steps more instructions
+    # (checked between basic blocks, so it may stop a little early). Returns the reason it stopped: 'halt', 'end' or
+    # 'limit'.
+    def run(self, max_steps=None):
+        blocks = self.blocks
+        r = self.registers
+        mem = self.memory
+        pc = self.pc
+        steps = self.steps
+        limit = None if max_steps is None else steps + max_steps
+        end = len(self.program) * ADDRESS_INCREMENT
+        reason = None
+        while True:
+            block = blocks.get(pc)
+            if block is None:
+                if not 0 <= pc < end:
+                    reason = 'end'
+                    break
+                block = blocks[pc] = compile_block(self.program, pc)
+            if limit is not None and steps + block.count > limit:
+                reason = 'limit'
+                break
+            next_pc = block.run(r, mem)
+            steps += block.count
+            if next_pc is None:
+                pc = block.end
+                self.halted = True
+                reason = 'halt'
+                break
+            pc = next_pc
+        self.pc = pc
+        self.steps = steps
+        return reason
+
+
+def main():
+    from encoder import assemble
+    from instructions import AssemblyError
+    from listing import SourceMap
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', metavar='INPUT', type=str, help='Assembly file to run')
+    parser.add_argument('-n', '--max_steps', metavar='N', type=int, help='Stop after about N instructions')
+    parser.add_argument('-O', '--optimize', action='store_const', const=True, default=False,
+                        help='Remove writes to $zero and jumps to the next instruction and fold consecutive addi')
+    parser.add_argument('--relax', action='store_const', const=True, default=False,
+                        help='Rewrite branches whose target is out of range into a branch over a jump')
+    parser.add_argument('-m', '--memory', metavar='ADDRESS', type=lambda value: int(value, 0), nargs='*', default=[],
+                        help='Data memory addresses to print at the end')
+    args = parser.parse_args()
+
+    with open(args.infile, 'r') as asmfile:
+        text = asmfile.read()
+        source_map = SourceMap()
+        try:
+            machine_code, labels = assemble(text, path=args.infile, relax=args.relax, optimize=args.optimize,
+                                            source_map=source_map)
+        except AssemblyError as e:
+            print('Error: {}'.format(e))
+            sys.exit(1)
+
+    simulator = Simulator(machine_code)
+    start = time.perf_counter()
+    try:
+        reason = simulator.run(args.max_steps)
+    except SimulationError as e:
+        print('Error: {}'.format(e))
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+
+    stopped = {'halt': 'Halted', 'end': 'Ran past the end of the program', 'limit': 'Reached the step limit'}[reason]
+    # Where it stopped in the source, e.g. "line 12, loop+4"
+    location = ''
+    line = source_map.line(simulator.pc, text)
+    if line is not None:
+        symbol = source_map.symbol(simulator.pc)
+        if symbol is None:
+            location = ' (line {})'.format(line)
+        else:
+            name, distance = symbol
+            location = ' (line {}, {}{})'.format(line, name, '+{}'.format(distance) if distance else '')
+    print('{} at address {}{} after {} instructions'.format(stopped, simulator.pc, location, simulator.steps))
+    print('{:.3f} s, {:.0f} instructions/second, {} basic blocks compiled'.format(
+        elapsed, simulator.steps / elapsed if elapsed > 0 else 0, len(simulator.blocks)))
+    for register in registers:
+        value = simulator.registers[register.address]
+        print('{:>6} = 0x{:04x} ({})'.format(register.name, value, signed(value)))
+    for address in args.memory:
+        value = simulator.memory[address & 0xFFFF]
+        print('mem[0x{:04x}] = 0x{:04x} ({})'.format(address & 0xFFFF, value, signed(value)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+import time
+
+# Timing and memory statistics for the phases of an assembly run (--stats).
+# Each phase records its wall time and, if memory tracking is on, the peak memory allocated while it ran (tracked with
+# tracemalloc, which slows everything down while it is on). Counters (e.g. from the parser) and rates are added to the
+# same report. Hooks are called with the Stats object and the PhaseStats after every phase, so other tools can collect
+# the numbers as they are measured.
+# Every run creates a (usually disabled) Stats, so tracemalloc and json are only imported once they are needed.
+
+
+class PhaseStats:
+    def __init__(self, name, seconds, peak_memory, memory_change):
+        self.name = name
+        self.seconds = seconds
+        self.peak_memory = peak_memory  # Bytes above the memory in use when the phase started, or None
+        self.memory_change = memory_change  # Bytes still allocated at the end of the phase, or None
+
+    def as_dict(self):
+        return {'name': self.name, 'seconds': self.seconds, 'peak_memory': self.peak_memory,
+                'memory_change': self.memory_change}
+
+
+class Stats:
+    # A disabled Stats measures nothing, so code can always time its phases
+    def __init__(self, enabled=True, memory=True, hooks=None):
+        self.enabled = enabled
+        self.memory = enabled and memory
+        self.hooks = list(hooks) if hooks is not None else []
+        self.phases = []
+        self.counters = {}
+        self.rates = {}
+        if self.memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    # Time the code in a with block as a phase. If profile_path is given, the phase is also run under cProfile and
+    # the profile is written to that file (readable with pstats).
+    @contextmanager
+    def phase(self, name, profile_path=None):
+        if not self.enabled:
+            yield
+            return
+        profiler = None
+        if profile_path is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+        if self.memory:
+            import tracemalloc
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            seconds = time.perf_counter() - start
+            peak_memory = memory_change = None
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak_memory = peak - start_memory
+                memory_change = current - start_memory
+            if profiler is not None:
+                profiler.dump_stats(profile_path)
+            phase = PhaseStats(name, seconds, peak_memory, memory_change)
+            self.phases.append(phase)
+            for hook in self.hooks:
+                hook(self, phase)
+
+    def phase_seconds(self, name):
+        return sum(phase.seconds for phase in self.phases if phase.name == name)
+
+    # Record count / (time of the phase) as a rate, e.g. instructions per second of the parse phase
+    def add_rate(self, name, count, phase_name):
+        if not self.enabled:
+            return
+        seconds = self.phase_seconds(phase_name)
+        self.rates[name] = count / seconds if seconds > 0 else None
+
+    def as_dict(self):
+        return {
+            'phases': [phase.as_dict() for phase in self.phases],
+            'total_seconds': sum(phase.seconds for phase in self.phases),
+            'counters': self.counters,
+            'rates': self.rates,
+        }
+
+    def to_json(self):
+        import json
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_text(self):
+        lines = ['{:<12} {:>10} {:>12} {:>12}'.format('phase', 'ms', 'peak KiB', 'kept KiB')]
+        for phase in self.phases:
+            lines.append('{:<12} {:>10.2f} {:>12} {:>12}'.format(
+                phase.name, phase.seconds * 1000, kib(phase.peak_memory), kib(phase.memory_change)))
+        lines.append('{:<12} {:>10.2f}'.format('total', sum(phase.seconds for phase in self.phases) * 1000))
+        for name, value in self.counters.items():
+            lines.append('{:<24} {:>12}'.format(name, value))
+        for name, value in self.rates.items():
+            lines.append('{:<24} {:>12}'.format(name, '-' if value is None else '{:.0f}'.format(value)))
+        return '\n'.join(lines)
+
+
+def kib(size):
+    return '-' if size is None else '{:.1f}'.format(size / 1024)
@@ -0,0 +1,39 @@
+from encoder import Assembler
+from output import RecordWriter
+from parser import parse_asm_fast, fast_skip_pattern, LineIndex, ParserInput
+
+
+# Streaming assembly for sources too large to hold in memory.
+# The source is read and parsed one line at a time and each instruction is written to the output as soon as it is
+# encoded. Instructions with forward references are written as placeholders and patched in place at the end, so only
+# labels and unresolved instructions are kept in memory. Every instruction and label must fit on a single line.
+
+
+# Parse an iterable of source lines. Yields (input, result) for each line that isn't blank or only a comment, where
+# result is a list of items or a ParseError. Error locations are reported with their line number in the whole source.
+def parse_lines(lines):
+    for line_no, line in enumerate(lines, 1):
+        if fast_skip_pattern.match(line).end() == len(line):
+            continue
+        parse_input = ParserInput(line, lazy_errors=True, lines=LineIndex(line, first_line=line_no))
+        result, rem = parse_asm_fast(parse_input)
+        yield parse_input, result
+
+
+# Assemble source lines into a seekable binary output file.
+# Returns a list of (input, error) for lines that failed to parse. Stops at the first one unless all_errors is set,
+# and only patches forward references if there were none. Label errors are raised as AssemblyError.
+def assemble_stream(lines, outfile, out_format, skip_odd, all_errors=False):
+    assembler = Assembler(RecordWriter(outfile, out_format, skip_odd))
+    errors = []
+    for parse_input, result in parse_lines(lines):
+        if result.error():
+            errors.append((parse_input, result))
+            if not all_errors:
+                break
+        elif not errors:
+            for item in result.value:
+                assembler.add(item)
+    if not errors:
+        assembler.finish()
+    return errors
@@ -0,0 +1,54 @@
+from argparse import Namespace
+from contextlib import redirect_stdout
+import io
+import os
+import tempfile
+import unittest
+
+from batch import assemble_batch
+from encoder import assemble
+
+
+def batch_args():
+    return Namespace(fast=False, numpy=False, all_errors=False, rom=False, skip_odd=False, base=0, cache=None,
+                     cache_size=None, cache_stats=False)
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, path, text):
+        path = os.path.join(self.directory.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as source:
+            source.write(text)
+        return path
+
+    def run_batch(self, infiles, outdir, workers):
+        with redirect_stdout(io.StringIO()):
+            return assemble_batch(infiles, outdir, 'words', batch_args(), workers)
+
+    def test_same_output_name_fails(self):
+        first = self.write('b1/p.asm', 'addi $s0, $s0, 1\nhalt\n')
+        second = self.write('b2/p.asm', 'addi $s1, $s1, 2\nhalt\n')
+        other = self.write('b1/q.asm', 'j 0\n')
+        outdir = os.path.join(self.directory.name, 'out')
+        for workers in (1, 2):
+            results = self.run_batch([first, second, other], outdir, workers)
+            failed = {result.infile for result in results if result.words is None}
+            self.assertEqual(failed, {first, second})
+            self.assertFalse(os.path.exists(os.path.join(outdir, 'p.hex')))
+            self.assertEqual(sorted(os.listdir(outdir)), ['q.hex'])
+
+    def test_outputs(self):
+        sources = {'a.asm': 'addi $s0, $s0, 1\nhalt\n', 'sub/b.asm': 'loop: j loop\n'}
+        infiles = [self.write(name, text) for name, text in sources.items()]
+        outdir = os.path.join(self.directory.name, 'out')
+        results = self.run_batch(infiles, outdir, 2)
+        self.assertEqual([result.words for result in results], [len(assemble(text)[0]) for text in sources.values()])
+
+
+if __name__ == '__main__':
+    unittest.main()
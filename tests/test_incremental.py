@@ -0,0 +1,32 @@
+import unittest
+
+from encoder import assemble
+from incremental import IncrementalAssembler
+
+
+class IncrementalAssemblerTest(unittest.TestCase):
+    # Every update must give the same machine code and labels as assembling the new source from scratch
+    def check_edits(self, *texts):
+        assembler = IncrementalAssembler()
+        for text in texts:
+            assembler.update(text)
+            machine_code, label_addresses = assemble(text)
+            self.assertEqual(assembler.machine_code, machine_code)
+            self.assertEqual({label.name: address for label, address in assembler.label_addresses.items()},
+                             label_addresses)
+
+    def test_lines_added_at_end(self):
+        self.check_edits('nop\nnop\n', 'nop\nnop\nfoo: add $s0, $s0, $s0\nj foo\n')
+
+    def test_labels_added_at_end(self):
+        self.check_edits('start: nop\nj start\n', 'start: nop\nj start\nfoo: nop\nj foo\n')
+
+    def test_lines_changed_and_removed(self):
+        self.check_edits('a: addi $s0, $s0, 1\nbne $s0, $s1, a\nhalt\n',
+                         'a: addi $s0, $s0, 2\nnop\nbne $s0, $s1, a\nhalt\n',
+                         'a: addi $s0, $s0, 2\n',
+                         'a: addi $s0, $s0, 2\nb: j a\nj b\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
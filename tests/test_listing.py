@@ -0,0 +1,38 @@
+import io
+import unittest
+
+from encoder import assemble_image
+from listing import SourceMap, write_listing
+
+
+class SourceMapTest(unittest.TestCase):
+    def assemble(self, text, fast):
+        source_map = SourceMap()
+        image, label_addresses = assemble_image(text, fast=fast, source_map=source_map)
+        return image, source_map
+
+    def test_source_starting_with_comment(self):
+        text = '; header comment\n; more\n\n    add $s0, $s0, $s0\n  nop\n'
+        for fast in (False, True):
+            image, source_map = self.assemble(text, fast)
+            self.assertEqual(source_map.line(0, text), 4)
+            self.assertEqual(source_map.line(2, text), 5)
+            self.assertIsNone(source_map.line(4, text))
+            listing = io.StringIO()
+            write_listing(listing, text, source_map, image)
+            lines = listing.getvalue().splitlines()
+            self.assertEqual(lines[0].split(), ['1', ';', 'header', 'comment'])
+            self.assertEqual(lines[3].split()[:3], ['4', '0000', '0490'])
+
+    def test_lookups(self):
+        text = 'start: j main\n.org 0x10\nmain: addi $s0, $s0, 1\nhalt\n'
+        image, source_map = self.assemble(text, True)
+        self.assertEqual(source_map.line(0x10, text), 3)
+        self.assertEqual(source_map.line(0x12, text), 4)
+        self.assertIsNone(source_map.line(0x08, text))
+        self.assertEqual(source_map.symbol(0x12), ('main', 2))
+        self.assertEqual(source_map.labels, {'start': 0, 'main': 0x10})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import unittest
+
+from encoder import assemble
+
+
+class PseudoInstructionTest(unittest.TestCase):
+    def test_labels_named_like_pseudo_instructions(self):
+        text = 'mov:\nli: add $s0, $s0, $s0\nbeq\nBEQ:  # comment\nj mov\nbne $s0, $s1, li\nj beq\n'
+        for fast in (False, True):
+            # The same labels with and without a directive that makes the source go through the preprocessor
+            machine_code, label_addresses = assemble(text, fast)
+            self.assertEqual(assemble('.org 0\n' + text, fast), (machine_code, label_addresses))
+            self.assertEqual(label_addresses, {'mov': 0, 'li': 0, 'beq': 2, 'BEQ': 2})
+
+    def test_pseudo_instructions(self):
+        expanded = 'addi $s0, $zero, 3\nadd $s1, $s0, $zero\nbne $s0, $s1, skip\nj end\nskip:\nend: halt\n'
+        machine_code, label_addresses = assemble(expanded)
+        self.assertEqual(assemble('li $s0, 3\nmov $s1, $s0\nbeq $s0, $s1, end\nend: halt\n')[0], machine_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+from encoder import assign_label_addresses, AssemblyError
+from instructions import ADDRESS_INCREMENT, RS, RT, RD, I_IMMEDIATE, J_IMMEDIATE, RType, IType, Branch, JType
+from parser import Label
+
+# NumPy is optional, it is only needed for batch encoding
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Batch encoding: instead of calling to_machine_code once per instruction, the parsed program is turned into one
+# array per instruction field and every word is computed at once with NumPy shifts and masks.
+
+# Instruction kinds, stored in the 'kind' column
+KIND_NONE = 0  # Only the opcode is set (nop, halt)
+KIND_R = 1
+KIND_I = 2
+KIND_BRANCH = 3
+KIND_J = 4
+
+# base is the instruction's precomputed base word (opcode, funct)
+COLUMNS = ['kind', 'base', 'rs', 'rt', 'rd', 'imm', 'target', 'address']
+
+
+def instruction_kind(instruction):
+    if isinstance(instruction, RType):
+        return KIND_R
+    elif isinstance(instruction, Branch):
+        return KIND_BRANCH
+    elif isinstance(instruction, IType):
+        return KIND_I
+    elif isinstance(instruction, JType):
+        return KIND_J
+    else:
+        return KIND_NONE
+
+
+# Split parsed items into one column per field. Labels are replaced by their addresses.
+def instruction_columns(items, label_addresses):
+    columns = {name: [] for name in COLUMNS}
+    kind, base, rs, rt, rd, imm, target, address = (columns[name] for name in COLUMNS)
+    addr = 0
+    for item in items:
+        if not hasattr(item.value, '__iter__'):  # Skip labels
+            if not isinstance(item.value, Label):
+                raise AssemblyError('Batch encoding does not support data directives (.org, .word, .fill, .space and '
+                                    '.incbin)')
+            continue
+        instruction = item.value[0].value
+        arguments = [it.value for it in item.value[1:]]
+        if arguments and isinstance(arguments[-1], Label):
+            try:
+                arguments[-1] = label_addresses[arguments[-1]]
+            except KeyError:
+                raise AssemblyError('Label "{}" is never defined'.format(arguments[-1].name))
+
+        k = instruction_kind(instruction)
+        kind.append(k)
+        base.append(instruction.base_word)
+        address.append(addr)
+        if k == KIND_R:
+            rd.append(arguments[0].address)
+            rs.append(arguments[1].address)
+            rt.append(arguments[2].address)
+        else:
+            rd.append(0)
+            if k == KIND_I or k == KIND_BRANCH:
+                rt.append(arguments[0].address)
+                rs.append(arguments[1].address)
+            else:
+                rt.append(0)
+                rs.append(0)
+        imm.append(arguments[2] if k == KIND_I else 0)
+        target.append(arguments[2] if k == KIND_BRANCH else arguments[0] if k == KIND_J else 0)
+        addr += ADDRESS_INCREMENT
+    return {name: np.array(values, dtype=np.int64) for name, values in columns.items()}
+
+
+# Raise an error listing the addresses of the rows that are set in bad
+def check_rows(bad, columns, error_msg):
+    if bad.any():
+        addresses = columns['address'][bad]
+        shown = ', '.join('0x{:04x}'.format(int(a)) for a in addresses[:10])
+        more = ' and {} more'.format(len(addresses) - 10) if len(addresses) > 10 else ''
+        raise AssemblyError('{} at {}{}'.format(error_msg, shown, more))
+
+
+# Compute every instruction word from the columns. Returns a uint16 array.
+def encode_columns(columns):
+    kind = columns['kind']
+    r_rows = kind == KIND_R
+    branch_rows = kind == KIND_BRANCH
+    imm_rows = (kind == KIND_I) | branch_rows
+    j_rows = kind == KIND_J
+
+    # Branch offsets are relative to the next instruction
+    imm = np.where(branch_rows, (columns['target'] - columns['address'] - ADDRESS_INCREMENT) // ADDRESS_INCREMENT,
+                   columns['imm'])
+    check_rows(imm_rows & ((imm < I_IMMEDIATE.min) | (imm > I_IMMEDIATE.max)), columns, 'Immediate out of range')
+
+    # Jump targets are absolute, divided by ADDRESS_INCREMENT because instruction memory is always word aligned
+    j_imm = columns['target'] // ADDRESS_INCREMENT
+    check_rows(j_rows & ((j_imm < J_IMMEDIATE.min) | (j_imm > J_IMMEDIATE.max)), columns, 'Jump target out of range')
+
+    words = columns['base'].copy()
+    words |= np.where(r_rows | imm_rows, (columns['rs'] << RS.position) | (columns['rt'] << RT.position), 0)
+    words |= np.where(r_rows, columns['rd'] << RD.position, 0)
+    words |= np.where(imm_rows, (imm & I_IMMEDIATE.mask) << I_IMMEDIATE.position, 0)
+    words |= np.where(j_rows, (j_imm & J_IMMEDIATE.mask) << J_IMMEDIATE.position, 0)
+    return words.astype(np.uint16)
+
+
+# Encode a parsed program. Returns the machine code as a uint16 array. label_addresses are computed from the items if
+# they aren't given (e.g. when the caller times the label pass separately).
+def encode_items(items, label_addresses=None):
+    if np is None:
+        raise AssemblyError('Batch encoding requires NumPy')
+    if label_addresses is None:
+        label_addresses = assign_label_addresses(items)
+    return encode_columns(instruction_columns(items, label_addresses))